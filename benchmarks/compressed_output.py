@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+'''
+Compares peak memory and time of compressing a large export built with
+`encode` and then compressed as a whole with streaming it through
+`CompressedWriter`. Rows are generated lazily, so memory is taken by
+output only. Every case runs in a forked process, so peak RSS is its own.
+
+    $ python benchmarks/compressed_output.py
+'''
+
+import os
+import sys
+import time
+import zlib
+import resource
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eplant import encode, encode_to, CompressedWriter
+from suite import run_isolated
+
+
+def make_plant(n):
+    return ('rows', (('row', {'id': str(i)},
+                        ('name', 'name %d' % i),
+                        ('value', 'value & more %d' % (i % 100)))
+                     for i in xrange(n)))
+
+
+def whole(n):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = encode(make_plant(n))
+    compressed = compressor.compress(data) + compressor.flush()
+    return len(data), len(compressed)
+
+
+def streamed(n):
+    sizes = []
+    with CompressedWriter(lambda data: sizes.append(len(data))) as out:
+        encode_to(out, make_plant(n), namespaces=[])
+    return out.raw_bytes, out.compressed_bytes
+
+
+def measure(func, n):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    raw, compressed = func(n)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on linux
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    return {'memory': memory, 'time': elapsed, 'raw': raw,
+            'compressed': compressed}
+
+
+def main(n=500000):
+    print '%d rows' % n
+    print '%-10s %12s %10s %12s %12s' % ('', 'memory KiB', 'time',
+                                         'raw bytes', 'gzip bytes')
+    for label, func in [('whole', whole), ('streamed', streamed)]:
+        result = run_isolated(measure, func, n)
+        print '%-10s %12d %9.2fs %12d %12d' % (
+            label, result['memory'], result['time'], result['raw'],
+            result['compressed'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''
+Compares signing digests of a SOAP message computed by re-parsing the
+encoded message and canonicalizing referenced elements with `lxml` with
+digests computed by `encode` while it writes canonical form.
+
+    $ python benchmarks/digests.py
+'''
+
+import os
+import sys
+import timeit
+import hashlib
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree
+
+from eplant import namespace, encode, Digests
+
+
+se = namespace('http://schemas.xmlsoap.org/soap/envelope/', 'se')
+wsse = namespace('http://docs.oasis-open.org/wss/2004/01/'
+                 'oasis-200401-wss-wssecurity-secext-1.0.xsd', 'wsse')
+wsu = namespace('http://docs.oasis-open.org/wss/2004/01/'
+                'oasis-200401-wss-wssecurity-utility-1.0.xsd', 'wsu')
+m = namespace('http://example.com/message/', 'm')
+
+
+def make_message(n=2000):
+    timestamp = (wsu.Timestamp, {wsu.Id: 'ts'},
+                   (wsu.Created, '2026-10-17T00:00:00Z'),
+                   (wsu.Expires, '2026-10-17T00:05:00Z'))
+    body = (se.Body, {wsu.Id: 'body'}, (m.Items,) + tuple(
+              (m.Item, {'id': str(i)},
+                  (m.Name, 'item %d & more' % i),
+                  (m.Price, '%d.00' % i))
+              for i in xrange(n)))
+    envelope = (se.Envelope,
+                  (se.Header, (wsse.Security, timestamp)),
+                  body)
+    return envelope, [timestamp, body]
+
+
+def reparse(envelope):
+    message = encode(envelope)
+    root = etree.fromstring(message)
+    digests = {}
+    for id in ['ts', 'body']:
+        element = root.xpath('//*[@wsu:Id=$id]', id=id,
+                             namespaces={'wsu': wsu.uri})[0]
+        digests[id] = hashlib.sha1(etree.tostring(
+            element, method='c14n', exclusive=True)).digest()
+    return message, digests
+
+
+def one_pass(envelope, marked):
+    digests = Digests(marked)
+    return encode(envelope, digests=digests), digests
+
+
+def main(number=10):
+    envelope, marked = make_message()
+    digests = one_pass(envelope, marked)[1]
+    assert [digests[s] for s in marked] == \
+           [reparse(envelope)[1][id] for id in ['ts', 'body']]
+    cases = [('encode', lambda: encode(envelope)),
+             ('encode + lxml c14n', lambda: reparse(envelope)),
+             ('encode digests', lambda: one_pass(envelope, marked))]
+    for label, func in cases:
+        timing = min(timeit.repeat(func, number=number, repeat=5))
+        print '%-20s %8.2fms' % (label, timing / number * 1e3)
+
+
+if __name__ == '__main__':
+    main()
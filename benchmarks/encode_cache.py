@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+Compares `encode` with and without `EncodeCache` on a document with
+repeated subtrees (the same address and code list in every order, built
+once and built per order), on a document without repeats and on a plant
+nested 100000 levels deep.
+
+    $ python benchmarks/encode_cache.py
+'''
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eplant import namespace, encode, EncodeCache
+
+
+ns = namespace('http://example.com/orders', 'o')
+
+
+def address():
+    return (ns.Address,
+              (ns.Street, 'Baker Street 221b'),
+              (ns.City, 'London'),
+              (ns.Country, 'United Kingdom'),
+              (ns.Phone, '+44 20 7224 3688'))
+
+
+def codes():
+    return (ns.Codes,) + tuple((ns.Code, 'code %d & more' % i)
+                               for i in range(10))
+
+
+def orders(n, shared):
+    if shared:
+        blocks = address(), codes()
+        make = lambda: blocks
+    else:
+        make = lambda: (address(), codes())
+    return (ns.Orders,) + tuple(
+        (ns.Order, {'id': str(i)}, (ns.Total, '%d.00' % i)) + make()
+        for i in xrange(n))
+
+
+def unique(n, start):
+    return (ns.Orders,) + tuple(
+        (ns.Order, (ns.Id, str(i)), (ns.Note, 'order %d' % i))
+        for i in xrange(start, start+n))
+
+
+def deep(depth):
+    tag = (ns.Leaf, 'text')
+    for i in xrange(depth):
+        tag = (ns.Node, tag)
+    return tag
+
+
+def main(n=2000, number=10, repeat=5, depth=100000):
+    count = number * repeat
+    cases = [('shared subtrees', [orders(n, True)] * count),
+             ('equal subtrees', [orders(n, False)] * count),
+             # every encoded document is a new one
+             ('no repeats', [unique(n, i*n) for i in xrange(count)])]
+    for label, documents in cases:
+        timings = []
+        for cache in [None, EncodeCache()]:
+            plants = iter(documents)
+            timing = min(timeit.repeat(
+                lambda: encode(next(plants), indent=2, cache=cache),
+                number=number, repeat=repeat))
+            timings.append(timing / number * 1e3)
+        print '%-16s %8.2fms %8.2fms cached, %d hits %d misses' % (
+            label, timings[0], timings[1], cache.hits, cache.misses)
+    # every lookup hashes the whole subtree, so only a few nested subtrees
+    # that missed are looked up
+    plant = deep(depth)
+    timings = []
+    for cache in [None, EncodeCache()]:
+        timing = min(timeit.repeat(lambda: encode(plant, cache=cache),
+                                   number=1, repeat=repeat))
+        timings.append(timing * 1e3)
+    print '%-16s %8.2fms %8.2fms cached, %d hits %d misses' % (
+        'deep plant', timings[0], timings[1], cache.hits, cache.misses)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+'''
+Scaling of `encode_parallel` with number of workers on a 100k nodes plant
+with 25k root children.
+
+    $ python benchmarks/encode_parallel.py
+'''
+
+import os
+import sys
+import time
+import multiprocessing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eplant import encode, encode_parallel
+from encode_single_pass import make_plant
+
+
+def timed(func):
+    best = None
+    for i in range(3):
+        start = time.time()
+        func()
+        spent = time.time() - start
+        best = spent if best is None else min(best, spent)
+    return best
+
+
+def main():
+    plant = make_plant()
+    print 'cpus: %d' % multiprocessing.cpu_count()
+    print '%-20s %.3fs' % ('encode', timed(lambda: encode(plant)))
+    assert encode_parallel(plant) == encode(plant)
+    for workers in (1, 2, 4, 8):
+        spent = timed(lambda: encode_parallel(plant, workers=workers,
+                                              chunk_size=2000))
+        print '%-20s %.3fs' % ('%d workers' % workers, spent)
+    # pool given by caller, so every chunk of the plant is pickled
+    pool = multiprocessing.Pool(4)
+    try:
+        spent = timed(lambda: encode_parallel(plant, pool=pool,
+                                              chunk_size=2000))
+    finally:
+        pool.close()
+        pool.join()
+    print '%-20s %.3fs' % ('4 workers, own pool', spent)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''
+Compares two pass `encode` (NamespaceCollector walk + encoding walk) with the
+single pass one on a 100k nodes plant.
+
+    $ python benchmarks/encode_single_pass.py
+'''
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eplant import (namespace, encode, update_tag, _encode_tag,
+                    NamespaceCollector)
+
+
+ns = namespace('urn:records', 'r')
+attr_ns = namespace('urn:attrs', 'a')
+
+
+def make_plant(nodes=100000):
+    # every record is 4 nodes
+    return (ns.Records,) + tuple(
+        (ns.Record, {attr_ns.id: i},
+            (ns.Name, 'name %d' % i),
+            (ns.Value, {'type': 'int'}, str(i)),
+            ('Comment', u'комментарий'))
+        for i in xrange(nodes // 4))
+
+
+def two_pass_encode(struct, indent=0):
+    namespaces = NamespaceCollector().visit(struct).namespaces
+    struct = update_tag(struct, attrs=namespaces)
+    return '<?xml version="1.0"?>\n%s' % _encode_tag(struct, indent=indent)
+
+
+def main():
+    plant = make_plant()
+    assert two_pass_encode(plant) == encode(plant)
+    for func in (two_pass_encode, encode):
+        best = min(timeit.repeat(lambda: func(plant), number=1, repeat=5))
+        print '%-16s %.3fs' % (func.__name__, best)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+'''
+Compares `xml.sax.saxutils` escaping with eplant escaping layer on ASCII,
+mostly safe and heavily escaped inputs.
+
+    $ python benchmarks/escaping.py
+'''
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xml.sax.saxutils import escape, quoteattr
+from eplant import safe, set_escape_cache, _escape_cdata, _quote_attr
+
+
+inputs = [
+    ('ascii', 'simple ascii value'),
+    ('enum', 'true'),
+    ('mostly safe', 'Terms & Conditions apply to ' * 4),
+    ('heavy', '<a href="x">&amp;</a>\n\t' * 4),
+    ('utf-8', u'текст без спецсимволов'.encode('utf-8')),
+]
+
+
+def run(func, value, number=200000):
+    return min(timeit.repeat(lambda: func(value), number=number, repeat=3))
+
+
+def main():
+    print '%-12s %10s %10s %10s %10s %10s %10s' % (
+        'input', 'escape', 'new', 'new+cache',
+        'quoteattr', 'new', 'new+cache')
+    for name, value in inputs:
+        timings = [run(lambda v: safe(escape(v)), value)]
+        set_escape_cache(0, 0)
+        timings.append(run(_escape_cdata, value))
+        set_escape_cache(1024, 1024)
+        timings.append(run(_escape_cdata, value))
+        timings.append(run(lambda v: safe(quoteattr(v)), value))
+        set_escape_cache(0, 0)
+        timings.append(run(_quote_attr, value))
+        set_escape_cache(1024, 1024)
+        timings.append(run(_quote_attr, value))
+        print '%-12s' % name + ' '.join('%9.3fs' % t for t in timings)
+    set_escape_cache()
+
+
+if __name__ == '__main__':
+    main()
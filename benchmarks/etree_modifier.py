@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''
+Compares filling fields of a message with repeated `EtreeModifier.set_text`
+calls (and with plain `find` per field, as it was done before paths were
+compiled) against a single `EtreeModifier.apply` call.
+
+    $ python benchmarks/etree_modifier.py
+'''
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eplant import namespace, to_etree, EtreeModifier
+
+
+se = namespace('http://schemas.xmlsoap.org/soap/envelope/', 'se')
+m = namespace('http://example.com/message/', 'm')
+namespaces = {'se': se.uri, 'm': m.uri}
+sections = 5
+fields = 8
+
+
+def make_plant():
+    return (se.Envelope,
+              (se.Header, (m.From, ''), (m.To, '')),
+              (se.Body,) + tuple(
+                  (m('Section%d' % i),) + tuple(
+                      (m('Field%d' % j), '') for j in range(fields))
+                  for i in range(sections)))
+
+
+values = dict(('se:Body/m:Section%d/m:Field%d' % (i, j), 'value %d' % j)
+              for i in range(sections) for j in range(fields))
+
+
+def find_each(tree):
+    for path, value in values.items():
+        ns = dict(namespaces)
+        tree.find(path, ns).text = value
+
+
+def set_text_each(tree):
+    modifier = EtreeModifier(tree, namespaces)
+    for path, value in values.items():
+        modifier.set_text(path, value)
+
+
+def apply_all(tree):
+    EtreeModifier(tree, namespaces).apply(values)
+
+
+def main(number=2000):
+    tree = to_etree(make_plant())
+    print '%d fields' % len(values)
+    for func in (find_each, set_text_each, apply_all):
+        timing = min(timeit.repeat(lambda: func(tree), number=number,
+                                   repeat=3))
+        print '%-14s %8.1fus' % (func.__name__, timing / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''
+Compares building a large constant document with `to_etree` per request
+and filling a few fields with `EtreeModifier.apply` against rendering the
+same document from `EtreeTemplate` skeleton.
+
+    $ python benchmarks/etree_template.py
+'''
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eplant import (namespace, to_etree, ElementTree, EtreeModifier,
+                    EtreeTemplate)
+
+
+se = namespace('http://schemas.xmlsoap.org/soap/envelope/', 'se')
+m = namespace('http://example.com/message/', 'm')
+namespaces = {'se': se.uri, 'm': m.uri}
+
+
+def make_plant(sections=20, fields=20):
+    return (se.Envelope,
+              (se.Header, (m.From, ''), (m.To, ''), (m.MessageId, '')),
+              (se.Body,) + tuple(
+                  (m('Section%d' % i), {'kind': 'constant'}) + tuple(
+                      (m('Field%d' % j), 'constant value %d' % j)
+                      for j in range(fields))
+                  for i in range(sections)))
+
+
+values = {'se:Header/m:From': 'me',
+          'se:Header/m:To': 'you',
+          'se:Header/m:MessageId': '42',
+          'se:Body/m:Section3/m:Field4': 'value',
+          ('se:Body/m:Section7', 'kind'): 'changed'}
+
+
+def main(number=200):
+    impls = [('xml.etree', ElementTree)]
+    try:
+        from lxml import etree
+        impls.append(('lxml', etree))
+    except ImportError:
+        pass
+    plant = make_plant()
+    for name, impl in impls:
+        def build():
+            tree = to_etree(plant, impl=impl)
+            EtreeModifier(tree, namespaces).apply(values)
+        template = EtreeTemplate(plant, namespaces, impl=impl)
+        render = lambda: template.render(values)
+        for label, func in (('to_etree+apply', build), ('render', render)):
+            timing = min(timeit.repeat(func, number=number, repeat=3))
+            print '%-10s %-15s %8.1fus' % (name, label,
+                                          timing / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
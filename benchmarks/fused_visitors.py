@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+'''
+Compares running several visitors one after another with running them in
+one walk with `visit_all`, and a visitor that skips subtrees it does not
+need with one that walks everything.
+
+    $ python benchmarks/fused_visitors.py
+'''
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eplant import namespace, Visitor, NamespaceCollector, visit_all
+
+
+se = namespace('http://schemas.xmlsoap.org/soap/envelope/', 'se')
+m = namespace('http://example.com/message/', 'm')
+
+
+def make_plant(n=5000):
+    return (se.Envelope,
+              (se.Header, (m.From, 'me'), (m.To, 'you')),
+              (se.Body,) + tuple(
+                  (m.Item, {'id': str(i)},
+                      (m.Name, 'item %d' % i),
+                      (m.Price, '%d.00' % i))
+                  for i in xrange(n)))
+
+
+class Counter(Visitor):
+
+    def __init__(self):
+        self.tags = 0
+
+    def visit_tag(self, name, attrs):
+        self.tags += 1
+
+
+class TextSize(Visitor):
+
+    def __init__(self):
+        self.size = 0
+
+    def visit_content(self, content):
+        self.size += len(content)
+
+
+class HeaderReader(Visitor):
+    '''Reads header fields, body is never walked'''
+
+    def __init__(self, prune):
+        self.prune = prune
+        self.fields = []
+
+    def visit_Body(self, name, attrs):
+        if self.prune:
+            return self.SKIP
+
+    def visit_From(self, name, attrs):
+        self.fields.append(name)
+
+
+def main(number=10):
+    plant = make_plant()
+    visitors = lambda: (NamespaceCollector(), Counter(), TextSize())
+    cases = [
+        ('3 walks', lambda: [v.visit(plant) for v in visitors()]),
+        ('visit_all', lambda: visit_all(plant, *visitors())),
+        ('header, full walk', lambda: HeaderReader(False).visit(plant)),
+        ('header, body skipped', lambda: HeaderReader(True).visit(plant)),
+    ]
+    for label, func in cases:
+        timing = min(timeit.repeat(func, number=number, repeat=5))
+        print '%-22s %8.2fms' % (label, timing / number * 1e3)
+
+
+if __name__ == '__main__':
+    main()
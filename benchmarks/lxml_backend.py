@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+'''
+Compares the generic `Planter` on `lxml.etree` (qnames resolved element by
+element) with `LxmlPlanter` (namespaces declared once on the root element),
+with and without explicit namespaces, and writing with `to_xmlfile`.
+Prints time to build and serialize the document and its size.
+
+    $ python benchmarks/lxml_backend.py
+'''
+
+import io
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree
+
+from eplant import namespace, Planter, LxmlPlanter, to_xmlfile
+
+
+ns = [namespace('http://example.com/ns%d' % i, 'ns%d' % i) for i in range(5)]
+
+
+def make_plant(n=5000):
+    return (ns[0].root,) + tuple(
+        (ns[i % 5].item, {ns[(i+1) % 5].attr: 'value', 'plain': 'value'},
+            (ns[(i+2) % 5].child, 'text %d' % i))
+        for i in xrange(n))
+
+
+def write(plant):
+    out = io.BytesIO()
+    with etree.xmlfile(out, encoding='utf-8') as xf:
+        to_xmlfile(xf, plant)
+    return out.getvalue()
+
+
+def main(number=10):
+    plant = make_plant()
+    generic, planter = Planter(etree), LxmlPlanter(etree)
+    cases = [
+        ('Planter', lambda: etree.tostring(generic.to_etree(plant))),
+        ('LxmlPlanter', lambda: etree.tostring(planter.to_etree(plant))),
+        ('LxmlPlanter[namespaces]',
+            lambda: etree.tostring(planter.to_etree(plant, ns))),
+        ('to_xmlfile', lambda: write(plant)),
+    ]
+    for label, func in cases:
+        timing = min(timeit.repeat(func, number=number, repeat=7))
+        print '%-25s %8.1fms %10d bytes' % (label, timing / number * 1e3,
+                                            len(func()))
+
+
+if __name__ == '__main__':
+    main()
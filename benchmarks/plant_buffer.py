@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+'''
+Compares memory, objects tracked by garbage collector and time of `encode`
+for a bulk generated document kept as tuple plant and as `PlantBuffer`.
+Every document is built in a forked process, so peak RSS is its own.
+
+    $ python benchmarks/plant_buffer.py
+'''
+
+import gc
+import os
+import sys
+import time
+import resource
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eplant import namespace, encode, PlantBuffer
+from suite import run_isolated
+
+
+ns = namespace('http://example.com/export', 'e')
+
+
+def rows(n):
+    return (('%d' % i, 'name %d' % i, 'value') for i in xrange(n))
+
+
+def build_plant(n):
+    return (ns.rows,) + tuple(
+        (ns.row, {'id': id},
+            (ns.name, name),
+            (ns.value, {'type': 'string'}, value))
+        for id, name, value in rows(n))
+
+
+def build_buffer(n):
+    buf = PlantBuffer()
+    buf.start(ns.rows)
+    for id, name, value in rows(n):
+        buf.start(ns.row, {'id': id})
+        buf.element(ns.name, None, name)
+        buf.element(ns.value, {'type': 'string'}, value)
+        buf.end()
+    buf.end()
+    return buf
+
+
+def measure(build, n):
+    gc.collect()
+    objects = len(gc.get_objects())
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    plant = build(n)
+    # ru_maxrss is in kilobytes on linux
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    objects = len(gc.get_objects()) - objects
+    start = time.time()
+    encode(plant)
+    return {'memory': memory, 'objects': objects,
+            'encode': time.time() - start}
+
+
+def main(n=200000):
+    print '%d rows' % n
+    print '%-12s %12s %12s %10s' % ('', 'memory KiB', 'gc objects', 'encode')
+    for label, build in (('tuples', build_plant), ('PlantBuffer', build_buffer)):
+        result = run_isolated(measure, build, n)
+        print '%-12s %12d %12d %9.3fs' % (label, result['memory'],
+                                          result['objects'], result['encode'])
+
+
+if __name__ == '__main__':
+    main()
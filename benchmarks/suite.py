@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark suite for eplant code paths on reproducible workloads: wide, deep,
+attribute-heavy, text-heavy, namespace-heavy and unicode-heavy plants.
+
+For every case it reports operations per second, peak memory of one
+operation and objects allocated per node. Memory is measured with
+`tracemalloc` where it is available, otherwise as growth of peak RSS of a
+forked process and as number of objects tracked by garbage collector.
+
+    $ python benchmarks/suite.py --save baseline.json
+    $ python benchmarks/suite.py --compare baseline.json
+
+With `--compare` cases that are slower or use more memory than baseline by
+more than `--threshold` are flagged and exit status is 1.
+'''
+
+import os
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from eplant import (namespace, to_etree, encode,
+                    NamespaceCollector, EtreeModifier, Sample)
+
+
+ns = [namespace('http://example.com/ns%d' % i, 'ns%d' % i) for i in range(5)]
+
+
+def wide(n):
+    return ('root',) + tuple(('item', 'text %d' % i) for i in xrange(n))
+
+
+def deep(n, depth=200):
+    '''Chains of `depth` nested nodes, indented output grows with depth'''
+    chain = ('leaf', 'text')
+    for i in xrange(depth - 1):
+        chain = ('node', {'level': str(i)}, chain)
+    return ('root',) + (chain,) * max(n // depth, 1)
+
+
+def attrs(n):
+    return ('root',) + tuple(
+        ('item', dict(('attr%d' % j, 'value %d' % j) for j in range(10)))
+        for i in xrange(n))
+
+
+def text(n):
+    return ('root',) + tuple(
+        ('item', 'Terms & Conditions <apply> to "all" %d. ' % i * 8)
+        for i in xrange(n))
+
+
+def namespaces(n):
+    return (ns[0].root,) + tuple(
+        (ns[i % 5].item, {ns[(i+1) % 5].attr: 'value', 'plain': 'value'},
+            (ns[(i+2) % 5].child, 'text'))
+        for i in xrange(n // 2))
+
+
+def unicode_text(n):
+    return ('root',) + tuple(
+        (u'элемент', {u'атрибут': u'значение %d' % i}, u'текст ' * 8)
+        for i in xrange(n))
+
+
+workloads = [('wide', wide), ('deep', deep), ('attrs', attrs),
+             ('text', text), ('namespaces', namespaces),
+             ('unicode', unicode_text)]
+
+
+def count_nodes(plant):
+    count, stack = 0, [plant]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(c for c in node[1:] if isinstance(c, tuple))
+    return count
+
+
+class Envelope(Sample):
+
+    def envelope(self):
+        return (ns[0].Envelope, self.header, self.body)
+
+    def header(self):
+        return (ns[0].Header, (ns[1].To, self.to), (ns[1].Id, self.msg_id))
+
+    def body(self):
+        return (ns[0].Body,) + tuple((ns[1].Item, {'n': str(i)}, self.text)
+                                     for i in xrange(self.items))
+
+
+message = (ns[0].Envelope,
+             (ns[0].Header, (ns[1].From, ''), (ns[1].To, '')),
+             (ns[0].Body,) + tuple(
+                 (ns[1]('Section%d' % i),) + tuple(
+                     (ns[1]('Field%d' % j), '') for j in range(8))
+                 for i in range(5)))
+message_values = dict(('ns0:Body/ns1:Section%d/ns1:Field%d' % (i, j), 'v')
+                      for i in range(5) for j in range(8))
+message_namespaces = dict((n.prefix, n.uri) for n in ns)
+
+
+def plant_cases():
+    '''Yields (name, function of plant) for cases that run on workloads'''
+    yield 'to_etree[xml.etree]', lambda plant: to_etree(plant)
+    if etree is not None:
+        yield 'to_etree[lxml]', lambda plant: to_etree(plant, impl=etree)
+    yield 'encode', lambda plant: encode(plant)
+    yield 'encode[indent]', lambda plant: encode(plant, indent=2)
+    yield 'NamespaceCollector', lambda plant: NamespaceCollector().visit(plant)
+
+
+def cases(size):
+    '''Yields (case name, node count, operation)'''
+    for workload, make in workloads:
+        plant = make(size)
+        nodes = count_nodes(plant)
+        for name, func in plant_cases():
+            yield '%s/%s' % (name, workload), nodes, \
+                  (lambda func, plant: lambda: func(plant))(func, plant)
+    tree = to_etree(message)
+    modifier_nodes = count_nodes(message)
+    yield 'EtreeModifier.set_text/message', modifier_nodes, lambda: [
+        EtreeModifier(tree, message_namespaces).set_text(path, value)
+        for path, value in message_values.items()]
+    yield 'EtreeModifier.apply/message', modifier_nodes, lambda: \
+        EtreeModifier(tree, message_namespaces).apply(message_values)
+    items = max(size // 10, 1)
+    yield 'Sample/envelope', items + 6, lambda: Envelope(
+        to='you', msg_id='1', text='text', items=items).envelope
+
+
+def ops_per_sec(func, min_time=0.2, repeat=3):
+    number, elapsed = 1, 0
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed
+    for i in xrange(repeat - 1):
+        start = time.time()
+        for i in xrange(number):
+            func()
+        best = min(best, time.time() - start)
+    return number / best
+
+
+def measure_memory(func, nodes):
+    '''Returns peak memory (bytes) and objects allocated per node'''
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in
+                     tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.stop()
+        del result
+        return peak, float(blocks) / nodes
+    before = len(gc.get_objects())
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = func()
+    objects = len(gc.get_objects()) - before
+    # ru_maxrss is in kilobytes on linux
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) * 1024
+    del result
+    return peak, float(objects) / nodes
+
+
+def run_isolated(func, *args):
+    '''Runs `func` in forked process, so peak RSS is not shared by cases'''
+    if not hasattr(os, 'fork'):
+        return func(*args)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            data = json.dumps(func(*args))
+        except BaseException as e:
+            data = json.dumps({'error': repr(e)})
+        os.write(write_fd, data)
+        os._exit(0)
+    os.close(write_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(chunks))
+
+
+def run_case(func, nodes):
+    peak, allocations = measure_memory(func, nodes)
+    return {'ops_per_sec': ops_per_sec(func),
+            'nodes': nodes,
+            'peak_memory': peak,
+            'allocations_per_node': allocations}
+
+
+# changes of memory metrics smaller than these are considered noise, peak
+# RSS grows by pages and allocator arenas
+memory_noise = {'peak_memory': 64 * 1024 if tracemalloc else 1024 * 1024,
+                'allocations_per_node': 0.5}
+
+
+def compare(results, baseline, threshold):
+    '''Returns list of (case, metric, baseline value, value) regressions'''
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or 'error' in result or 'error' in base:
+            continue
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - threshold):
+            regressions.append((name, 'ops_per_sec',
+                                base['ops_per_sec'], result['ops_per_sec']))
+        for metric, noise in memory_noise.items():
+            if result[metric] > base[metric] * (1 + threshold) and \
+                    result[metric] - base[metric] > noise:
+                regressions.append((name, metric, base[metric],
+                                    result[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=10000,
+                        help='nodes in workload plants')
+    parser.add_argument('--quick', action='store_true',
+                        help='small workloads for a fast check')
+    parser.add_argument('--filter', default='',
+                        help='run only cases containing this substring')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save results as JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare results with JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change flagged as regression')
+    args = parser.parse_args(argv)
+    size = 1000 if args.quick else args.size
+    results = {}
+    print '%-40s %12s %12s %12s' % ('case', 'ops/sec', 'peak KiB',
+                                    'allocs/node')
+    for name, nodes, func in cases(size):
+        if args.filter not in name:
+            continue
+        result = results[name] = run_isolated(run_case, func, nodes)
+        if 'error' in result:
+            print '%-40s %s' % (name, result['error'])
+            continue
+        print '%-40s %12.1f %12.1f %12.2f' % (
+            name, result['ops_per_sec'], result['peak_memory'] / 1024.,
+            result['allocations_per_node'])
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump({'python': platform.python_version(),
+                       'tracemalloc': tracemalloc is not None,
+                       'size': size,
+                       'results': results}, fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline.get('size') != size:
+            print 'baseline was recorded with size %s' % baseline.get('size')
+        regressions = compare(results, baseline['results'], args.threshold)
+        for name, metric, base, value in regressions:
+            print 'REGRESSION %s %s: %.1f -> %.1f' % (name, metric, base,
+                                                      value)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,13 +23,25 @@ Example:
     '<SomeRootTag><FirstChild>text</FirstChild><SecondChild attr="value">text</SecondChild></SomeRootTag>'
 '''
 
+import os
+import re
+import sys
+import copy
+import time
+import array
+import zlib
+import codecs
+import hashlib
 import types
+import thread
 import functools
+import threading
+import collections
+import multiprocessing
 try:
     from xml.etree import cElementTree as ElementTree
 except ImportError:
     from xml.etree import ElementTree
-from xml.sax.saxutils import escape, quoteattr
 
 
 def is_eplant_node(obj):
@@ -38,27 +50,115 @@ def is_eplant_node(obj):
            isinstance(obj[0], basestring)
 
 
+def _is_lazy(obj):
+    '''
+    Lazy children are generators and other iterables that are not plants,
+    their items are children of the node and are consumed only once.
+    '''
+    return hasattr(obj, '__iter__') and \
+           not isinstance(obj, (tuple, list, dict))
+
+
+# types of children that are never lazy
+_plain_children = frozenset([str, unicode, tuple, list])
+_end = object()
+
+
+class _Children(object):
+    '''
+    Iterator over children with lazy children spliced in place. Iterators of
+    lazy children are kept on a stack instead of nested chains, so fetching
+    a child costs the same however many lazy children were spliced before.
+    '''
+    __slots__ = ('stack',)
+
+    def __init__(self, children):
+        self.stack = [iter(children)]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        stack = self.stack
+        while stack:
+            for child in stack[-1]:
+                if type(child) not in _plain_children and _is_lazy(child):
+                    stack.append(iter(child))
+                    break
+                return child
+            else:
+                stack.pop()
+        raise StopIteration
+
+
+def _splice(children, *iterables):
+    '''
+    Returns iterator over items of `iterables` followed by the rest of
+    iterator `children`, lazy children are spliced in place.
+    '''
+    if type(children) is not _Children:
+        children = _Children(children)
+    children.stack.extend(iter(items) for items in reversed(iterables))
+    return children
+
+
+def _next_child(children):
+    '''
+    Returns next child from iterator `children` (or `_end`) and iterator of
+    the rest, lazy children are spliced in place.
+    '''
+    child = next(children, _end)
+    if type(child) not in _plain_children and child is not _end and \
+            _is_lazy(child):
+        children = _splice(children, child)
+        child = next(children, _end)
+    return child, children
+
+
+def _iter_children(children):
+    '''Iterates over `children` with lazy children spliced in place'''
+    child, children = _next_child(iter(children))
+    while child is not _end:
+        yield child
+        child, children = _next_child(children)
+
+
 class namespace(object):
+    '''
+    Namespace with given `uri` and `prefix`. Qnames are created once per
+    name and then reused, so `ns.name` is as cheap as an attribute lookup.
+    '''
 
     def __init__(self, uri, prefix):
         self.uri = uri
         self.prefix = prefix
+        self._qnames = {}
 
     def __call__(self, name, force=False):
         if isinstance(name, qname):
             if not force:
                 return name
             name = name.name
-        return qname(name, self.uri, self.prefix)
+        try:
+            return self._qnames[name]
+        except KeyError:
+            value = self._qnames[name] = qname(name, self.uri, self.prefix)
+            return value
 
     def __div__(self, name):
         return self(name)
 
-    __getattr__ = __div__
+    def __getattr__(self, name):
+        value = self(name)
+        # next time it is found in instance dict without `__getattr__` call
+        self.__dict__[name] = value
+        return value
 
 
 class qname(unicode):
 
+    __slots__ = ('name', 'uri', 'prefix', 'clark')
+
     def __new__(cls, name, uri='', prefix=None, **kwargs):
         self = unicode.__new__(cls,
                                u'%s:%s' % (prefix, name) if uri else name,
@@ -66,13 +166,31 @@ class qname(unicode):
         self.name = name
         self.uri = uri
         self.prefix = prefix
+        # Clark notation used by etree implementations
+        self.clark = '{%s}%s' % (uri, name)
         return self
 
+    def __reduce__(self):
+        return qname, (self.name, self.uri, self.prefix)
+
     def __repr__(self):
         return '<qname %s uri=%r>' % (unicode.__repr__(self), self.uri)
 
     def to_etree(self):
-        return '{%s}%s' % (self.uri, self.name)
+        return self.clark
+
+
+_etree_qnames = {}
+
+
+def _etree_qname(impl, name):
+    '''Returns `impl.QName` for qname `name`, cached per implementation'''
+    try:
+        return _etree_qnames[impl][name.clark]
+    except KeyError:
+        value = _etree_qnames.setdefault(impl, {})[name.clark] = \
+                impl.QName(name.clark)
+        return value
 
 
 def _unpack(struct):
@@ -86,70 +204,766 @@ def _unpack(struct):
     return name, dict(attrs), children
 
 
+_TEXT = -1
+_END = -2
+
+
+class PlantBuffer(object):
+    '''
+    Compact plant for large generated documents, built with events instead
+    of tuples and dicts:
+
+        buf = PlantBuffer()
+        buf.start('rows')
+        for id, name in cursor:
+            buf.element('row', {'id': id}, name)
+        buf.end()
+        encode(buf)
+
+    Events are kept in a flat array of name indexes and counts, names are
+    interned per buffer, text and attribute values are kept in one list.
+    `encode`, `encode_iter`, `to_etree` and `Visitor` accept it in place of
+    a plant. Namespaces are known from the names, so they are never
+    collected with an extra pass.
+    '''
+
+    def __init__(self):
+        self._names = []
+        self._name_index = {}
+        # start: name index, number of attributes, their name indexes;
+        # text: `_TEXT`; end: `_END`
+        self._codes = array.array('i')
+        self._values = []
+        self._open = []
+        self._closed = False
+
+    def _name(self, name):
+        # qname is equal to unprefixed `prefix:name` string, and qnames of
+        # one namespace are written with their own prefixes
+        key = (name.prefix, name.clark) if isinstance(name, qname) else name
+        try:
+            return self._name_index[key]
+        except KeyError:
+            index = self._name_index[key] = len(self._names)
+            self._names.append(name)
+            return index
+
+    def start(self, name, attrs=None):
+        '''Opens element `name` with `attrs` dict'''
+        if self._closed:
+            raise ValueError('Root element is already closed')
+        index = self._name(name)
+        codes = self._codes
+        codes.append(index)
+        if attrs:
+            codes.append(len(attrs))
+            for k, v in attrs.iteritems():
+                codes.append(self._name(k))
+                self._values.append(v)
+        else:
+            codes.append(0)
+        self._open.append(index)
+
+    def text(self, text):
+        '''Adds text to the open element'''
+        if not self._open:
+            raise ValueError('Text outside of root element')
+        self._codes.append(_TEXT)
+        self._values.append(text)
+
+    def end(self):
+        '''Closes the open element'''
+        if not self._open:
+            raise ValueError('No element to close')
+        self._open.pop()
+        self._codes.append(_END)
+        self._closed = not self._open
+
+    def element(self, name, attrs=None, text=None):
+        '''Adds element `name` with `attrs` and `text`'''
+        self.start(name, attrs)
+        if text is not None:
+            self.text(text)
+        self.end()
+
+    def qnames(self):
+        '''Returns qnames of tags and attributes'''
+        return [n for n in self._names if isinstance(n, qname)]
+
+    def _events(self):
+        '''
+        Yields `(name, attrs, empty)` for start of element, text for text
+        and `_end` for end of element. Empty elements have no end event.
+        '''
+        if not self._closed:
+            raise ValueError('Plant buffer has unclosed elements')
+        names, codes, values = self._names, self._codes, self._values
+        i = v = 0
+        length = len(codes)
+        while i < length:
+            code = codes[i]
+            if code == _TEXT:
+                yield values[v]
+                v += 1
+                i += 1
+            elif code == _END:
+                yield _end
+                i += 1
+            else:
+                count = codes[i+1]
+                attrs = {}
+                for j in xrange(i+2, i+2+count):
+                    attrs[names[codes[j]]] = values[v]
+                    v += 1
+                i += 2 + count
+                empty = codes[i] == _END
+                if empty:
+                    i += 1
+                yield names[code], attrs, empty
+
+
+def _iter_encode_buffer(buffer, indent, codec, declared):
+    '''The same as `_iter_encode_tag`, but for `PlantBuffer`'''
+    encode = codec.encode
+    stack = []
+    # `closed` means that last child of the top element is a closed tag
+    closed = False
+    for event in buffer._events():
+        level = len(stack)
+        if type(event) is tuple:
+            name, attrs, empty = event
+            if not stack:
+                attrs.update(declared)
+            if closed:
+                yield encode(' '*indent*(level-1))
+                closed = False
+            if indent and level:
+                yield encode('\n' + ' '*indent*level)
+            yield codec.start_tag(name, attrs, empty)
+            if empty:
+                closed = True
+            else:
+                stack.append(name)
+        elif event is _end:
+            if closed:
+                if indent:
+                    yield encode('\n')
+                yield encode(' '*indent*(level-1))
+            yield codec.end_tag(stack.pop())
+            closed = True
+        else:
+            if closed:
+                yield encode(' '*indent*(level-1))
+                closed = False
+            yield codec.text(event)
+
+
 identity = lambda i,v: v
 _type_converters = {
     type(None): lambda i,v: u'',
-    str: lambda i,v: v.decode('utf-8'),
+    str: lambda i,v: unicode(v, 'utf-8'),
     unicode: identity,
     int: lambda i,v: unicode(v),
     float: lambda i,v: unicode(v),
     bool: lambda i,v: unicode(v).lower(),
-    qname: lambda i,v: i.QName(v.to_etree()),
+    qname: _etree_qname,
 }
 
 
-def to_etree(struct, impl=ElementTree, converters=None, _level=0):
-    '''Transforms to etree representation. Optionaly you can provide a custom
-    `ElementTree` implementation module, for example `lxml.etree`
-    converters - `dict[type:callable(impl, value)->unicode]`'''
-    if not _level:
-        converters = dict(_type_converters, **(converters or {}))
-    if not is_eplant_node(struct):
-        raise ValueError('Not an eplant structure')
-    name, attrs, children = _unpack(struct)
-    if isinstance(name, qname):
-        name = impl.QName(name.to_etree())
-    for k,v in attrs.items():
-        if isinstance(k, qname):
-            attrs.pop(k)
-            k = k.to_etree()
-        for t in type(v).__mro__:
-            if t in converters:
-                v = converters[t](impl, v)
-        attrs[k] = v
-    node = impl.Element(name, attrs)
-    content = None
-    last_child = None
-    for child in children:
-        if is_eplant_node(child):
-            if content:
+class Planter(object):
+    '''
+    Reusable `to_etree` for given `impl` and `converters`. Converter for every
+    value type is looked up in `type.__mro__` only once and then cached, so
+    it is cheaper to keep a `Planter` instance than to call `to_etree` with
+    custom converters again and again.
+    '''
+
+    def __init__(self, impl=ElementTree, converters=None):
+        self.impl = impl
+        self.converters = dict(_type_converters, **(converters or {}))
+        self._attr_converters = {}
+        self._text_converters = {}
+
+    def _resolve(self, tp, text):
+        for t in tp.__mro__:
+            #Note: this special hack is `xml.etree.ElementTree` related
+            if text and t is qname and self.impl is ElementTree:
+                return False
+            if t in self.converters:
+                return self.converters[t]
+        return None
+
+    def attr_converter(self, tp):
+        try:
+            return self._attr_converters[tp]
+        except KeyError:
+            converter = self._attr_converters[tp] = self._resolve(tp, False)
+            return converter
+
+    def text_converter(self, tp):
+        try:
+            return self._text_converters[tp]
+        except KeyError:
+            converter = self._text_converters[tp] = self._resolve(tp, True)
+            return converter
+
+    def convert_text(self, value, node=None):
+        try:
+            converter = self._text_converters[type(value)]
+        except KeyError:
+            converter = self.text_converter(type(value))
+        if not converter:
+            if converter is False:
+                raise ValueError('xml.etree.ElementTree does not '
+                                 'support `Qname` as tag content: '
+                                 '%r' % node)
+            raise ValueError('Unknown type %r' % value)
+        return converter(self.impl, value)
+
+    def _make_element(self, struct, parent=None, nsmap=None):
+        impl = self.impl
+        converters = self._attr_converters
+        name, attrs, children = _unpack(struct)
+        if isinstance(name, qname):
+            name = _etree_qname(impl, name)
+        for k,v in attrs.items():
+            if isinstance(k, qname):
+                attrs.pop(k)
+                k = k.clark
+            try:
+                converter = converters[type(v)]
+            except KeyError:
+                converter = self.attr_converter(type(v))
+            if converter is not None:
+                v = converter(impl, v)
+            attrs[k] = v
+        if parent is None:
+            if nsmap:
+                # lxml only
+                return impl.Element(name, attrs, nsmap=nsmap), children
+            return impl.Element(name, attrs), children
+        return impl.SubElement(parent, name, attrs), children
+
+    def _rooted(self, nsmap, grow):
+        '''
+        Calls `grow()` that converts values for a tree with `nsmap` declared
+        on its root element, it matters for `LxmlPlanter` only
+        '''
+        return grow()
+
+    def to_etree(self, struct):
+        '''Transforms to etree representation'''
+        if isinstance(struct, PlantBuffer):
+            return self._grow_buffer(struct)
+        if not is_eplant_node(struct):
+            raise ValueError('Not an eplant structure')
+        return self._grow(*self._make_element(struct))
+
+    def _grow_buffer(self, buffer, nsmap=None):
+        '''Builds etree from `PlantBuffer` events, returns root element'''
+        impl = self.impl
+        root = None
+        # stack of [element, last child]
+        stack = []
+        for event in buffer._events():
+            if type(event) is tuple:
+                name, attrs, empty = event
+                if stack:
+                    element = self._make_element((name, attrs),
+                                                 stack[-1][0])[0]
+                    stack[-1][1] = element
+                else:
+                    element = root = self._make_element((name, attrs), None,
+                                                        nsmap)[0]
+                if not empty:
+                    stack.append([element, None])
+                continue
+            if event is _end:
+                stack.pop()
+                continue
+            node, last_child = stack[-1]
+            if isinstance(event, fragment):
+                text, elements = event.to_etree(impl)
+            else:
+                text, elements = self.convert_text(event, node), ()
+            if text:
                 if last_child is not None:
-                    last_child.tail = content
+                    last_child.tail = (last_child.tail or '') + text
                 else:
-                    node.text = content
-                content = None
-            last_child = to_etree(child, impl, converters, _level+1)
-            node.append(last_child)
-            continue
-        match = False
-        for t in type(child).__mro__:
-            #Note: this special hack is `xml.etree.ElementTree` related
-            if t is qname and impl is ElementTree:
-                raise ValueError('xml.etree.ElementTree does not support '
-                                 '`Qname` as tag content: %r' % node)
-            if t in converters:
-                value = converters[t](impl, child)
+                    node.text = (node.text or '') + text
+            if elements:
+                node.extend(elements)
+                stack[-1][1] = elements[-1]
+        return root
+
+    def _grow(self, root, children):
+        '''Adds `children` to `root` element, returns `root`'''
+        impl = self.impl
+        converters = self._text_converters
+        # explicit stack of [node, children iterator, content, last_child],
+        # so depth of the structure is not limited by recursion limit
+        stack = [[root, iter(children), None, None]]
+        while stack:
+            frame = stack[-1]
+            node, children, content, last_child = frame
+            for child in children:
+                if is_eplant_node(child):
+                    if content:
+                        if last_child is not None:
+                            last_child.tail = content
+                        else:
+                            node.text = content
+                        content = None
+                    last_child, grandchildren = self._make_element(child,
+                                                                   node)
+                    frame[2], frame[3] = content, last_child
+                    stack.append([last_child, iter(grandchildren), None, None])
+                    break
+                converter = converters.get(type(child))
+                if converter:
+                    value = converter(impl, child)
+                elif isinstance(child, fragment):
+                    value, elements = child.to_etree(impl)
+                    if value:
+                        content = value if content is None \
+                                        else content + value
+                    if not elements:
+                        continue
+                    if content:
+                        if last_child is not None:
+                            last_child.tail = content
+                        else:
+                            node.text = content
+                    node.extend(elements)
+                    last_child = elements[-1]
+                    content, last_child.tail = last_child.tail, None
+                    continue
+                elif _is_lazy(child):
+                    frame[1] = _splice(children, child)
+                    frame[2], frame[3] = content, last_child
+                    break
+                else:
+                    value = self.convert_text(child, node)
                 content = value if content is None else content + value
-                match = True
+            else:
+                stack.pop()
+                if content is not None:
+                    if last_child is not None:
+                        last_child.tail = content
+                    else:
+                        node.text = content
+        return root
+
+
+_planters = {}
+
+
+class Stats(object):
+    '''
+    Opt-in instrumentation, pass it as `stats` to `to_etree`, `encode`,
+    `encode_iter` or `encode_to`. Counts are accumulated over calls:
+    `nodes`, `attributes`, `converters` (calls per value type name),
+    `escaped_bytes` (output of escaped text and attribute values),
+    `output_bytes` and `timings` (seconds per phase: `namespaces`,
+    `to_etree`, `encode` and `join`). Without it nothing is counted.
+    '''
+
+    def __init__(self):
+        self.nodes = 0
+        self.attributes = 0
+        self.converters = {}
+        self.escaped_bytes = 0
+        self.output_bytes = 0
+        self.timings = {}
+
+    def count_converter(self, tp):
+        name = tp.__name__
+        self.converters[name] = self.converters.get(name, 0) + 1
+
+    def add_time(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def as_dict(self):
+        '''Returns flat dict of all counters, e.g. for export to metrics'''
+        result = {'nodes': self.nodes,
+                  'attributes': self.attributes,
+                  'escaped_bytes': self.escaped_bytes,
+                  'output_bytes': self.output_bytes}
+        for name, count in self.converters.items():
+            result['converters.' + name] = count
+        for phase, seconds in self.timings.items():
+            result['timings.' + phase] = seconds
+        return result
+
+
+def _collect_nsmap(struct, nsmap):
+    '''
+    Adds prefixes of all qnames in `struct` to lxml `nsmap` (prefix -> uri),
+    the first namespace wins a prefix. Qnames in content and attribute
+    values are written as `prefix:name`, so they win prefixes over names of
+    tags and attributes, which lxml declares where they are used. Lazy
+    children are not consumed.
+    '''
+    # qnames are seen in names, attributes and content, nested plants are
+    # walked with explicit stack of iterators
+    seen = set()
+    names = {}
+    stack = [iter((struct,))]
+    while stack:
+        for child in stack[-1]:
+            tp = type(child)
+            if tp is tuple or tp is list:
+                items = iter(child)
+                name = next(items, None)
+                if type(name) is qname:
+                    names.setdefault(name.prefix, name.uri)
+                stack.append(items)
                 break
-        if not match:
-            raise ValueError('Unknown type %r' % child)
-    if content is not None:
-        if last_child is not None:
-            last_child.tail = content
+            if tp is dict:
+                for k, v in child.iteritems():
+                    if type(k) is qname:
+                        names.setdefault(k.prefix, k.uri)
+                    if type(v) is qname and v not in seen:
+                        seen.add(v)
+                        nsmap.setdefault(v.prefix, v.uri)
+            elif tp is qname and child not in seen:
+                seen.add(child)
+                nsmap.setdefault(child.prefix, child.uri)
+        else:
+            stack.pop()
+    for prefix, uri in names.iteritems():
+        nsmap.setdefault(prefix, uri)
+    nsmap.pop(None, None)
+    return nsmap
+
+
+def _lxml():
+    from lxml import etree
+    return etree
+
+
+class LxmlPlanter(Planter):
+    '''
+    `Planter` for `lxml.etree`. Namespaces are declared once on the root
+    element with prefixes of qnames, instead of on every element that uses
+    them. They are collected with a walk over the plant, unless
+    `namespaces` (list of `namespace` objects) are given. Qnames in content
+    and attribute values are written as `prefix:name`, so their namespaces
+    must be declared on the root: used outside lazy children or given in
+    `namespaces`, otherwise ValueError is raised.
+    '''
+
+    def __init__(self, impl=None, converters=None):
+        Planter.__init__(self, impl or _lxml(), converters)
+        # nsmap of the root element being built, per thread
+        self._local = threading.local()
+
+    def _resolve(self, tp, text):
+        converter = Planter._resolve(self, tp, text)
+        if converter is _etree_qname:
+            return self._qname_value
+        return converter
+
+    def _qname_value(self, impl, value):
+        '''
+        Content and attribute values are written with prefix declared on the
+        root element, it must be bound to the namespace of `value`.
+        '''
+        nsmap = getattr(self._local, 'nsmap', None) or {}
+        if nsmap.get(value.prefix) != value.uri:
+            raise ValueError('Prefix of %r is not declared for its namespace '
+                             'on the root element' % value)
+        return unicode(value)
+
+    def _rooted(self, nsmap, grow):
+        '''Calls `grow()` with `nsmap` declared on the root element'''
+        local = self._local
+        outer = getattr(local, 'nsmap', None)
+        local.nsmap = nsmap
+        try:
+            return grow()
+        finally:
+            local.nsmap = outer
+
+    def _attrs(self, attrs):
+        '''Returns new dict of attributes with Clark names and text values'''
+        impl = self.impl
+        converters = self._attr_converters
+        result = {}
+        for k, v in attrs.iteritems():
+            if isinstance(k, qname):
+                k = k.clark
+            try:
+                converter = converters[type(v)]
+            except KeyError:
+                converter = self.attr_converter(type(v))
+            result[k] = v if converter is None else converter(impl, v)
+        return result
+
+    def _make_element(self, struct, parent=None, nsmap=None):
+        impl = self.impl
+        name = struct[0]
+        if isinstance(name, qname):
+            name = name.clark
+        if len(struct) > 1 and isinstance(struct[1], dict):
+            attrs, children = self._attrs(struct[1]), struct[2:]
         else:
-            node.text = content
-    return node
+            attrs, children = None, struct[1:]
+        if parent is not None:
+            return impl.SubElement(parent, name, attrs), children
+        return impl.Element(name, attrs, nsmap=nsmap), children
+
+    def _nsmap(self, struct, namespaces):
+        if namespaces is not None:
+            return dict((ns.prefix, ns.uri) for ns in namespaces)
+        if isinstance(struct, PlantBuffer):
+            nsmap = {}
+            for n in struct.qnames():
+                nsmap.setdefault(n.prefix, n.uri)
+            return nsmap
+        return _collect_nsmap(struct, {})
+
+    def to_etree(self, struct, namespaces=None):
+        '''Transforms to `lxml.etree` element'''
+        if isinstance(struct, PlantBuffer):
+            nsmap = self._nsmap(struct, namespaces)
+            return self._rooted(nsmap,
+                                lambda: self._grow_buffer(struct, nsmap))
+        if not is_eplant_node(struct):
+            raise ValueError('Not an eplant structure')
+        nsmap = self._nsmap(struct, namespaces)
+        return self._rooted(nsmap, lambda: self._grow(
+            *self._make_element(struct, None, nsmap)))
+
+    def _write_content(self, xf, value):
+        if isinstance(value, fragment):
+            text, elements = value.to_etree(self.impl)
+            xf.write(text)
+            for element in elements:
+                xf.write(element)
+        else:
+            xf.write(self.convert_text(value))
+
+    def write(self, xf, struct, namespaces=None):
+        '''
+        Writes `struct` to `xf` (opened `lxml.etree.xmlfile`) element by
+        element, so no tree is built and lazy children are written as
+        they are produced.
+        '''
+        if not is_eplant_node(struct):
+            raise ValueError('Not an eplant structure')
+        nsmap = self._nsmap(struct, namespaces)
+        self._rooted(nsmap, lambda: self._write(xf, struct, nsmap))
+
+    def _write(self, xf, struct, nsmap):
+        # explicit stack of [opened element context, children iterator]
+        stack = []
+        child = struct
+        while True:
+            if child is _end:
+                stack.pop()[0].__exit__(None, None, None)
+                if not stack:
+                    break
+            elif is_eplant_node(child):
+                name, attrs, children = _unpack(child)
+                if isinstance(name, qname):
+                    name = name.clark
+                context = xf.element(name, self._attrs(attrs), nsmap=nsmap)
+                context.__enter__()
+                nsmap = None
+                stack.append([context, iter(children)])
+            else:
+                self._write_content(xf, child)
+            child, stack[-1][1] = _next_child(stack[-1][1])
+
+
+class _CountingPlanter(Planter):
+    '''`Planter` that counts elements, attributes and converter calls'''
+
+    def __init__(self, impl, converters, stats):
+        super(_CountingPlanter, self).__init__(impl, converters)
+        self.stats = stats
+
+    def _resolve(self, tp, text):
+        converter = super(_CountingPlanter, self)._resolve(tp, text)
+        if not converter:
+            return converter
+        stats = self.stats
+        def counted(impl, value):
+            stats.count_converter(tp)
+            return converter(impl, value)
+        return counted
+
+    def _make_element(self, struct, parent=None, nsmap=None):
+        element, children = super(_CountingPlanter, self)._make_element(
+            struct, parent, nsmap)
+        self.stats.nodes += 1
+        self.stats.attributes += len(element.attrib)
+        return element, children
+
+
+class _CountingLxmlPlanter(_CountingPlanter, LxmlPlanter):
+    pass
+
+
+def _planter_class(impl):
+    return LxmlPlanter if hasattr(impl, 'LXML_VERSION') else Planter
+
+
+def to_etree(struct, impl=ElementTree, converters=None, stats=None,
+             namespaces=None):
+    '''Transforms to etree representation. Optionaly you can provide a custom
+    `ElementTree` implementation module, for example `lxml.etree`
+    converters - `dict[type:callable(impl, value)->unicode]`
+    stats - `Stats` instance to count into
+    namespaces - list of `namespace` objects to declare on the root element
+    (`lxml.etree` only, by default namespaces of the plant are declared)'''
+    cls = _planter_class(impl)
+    args = (struct, namespaces) if cls is LxmlPlanter else (struct,)
+    if stats is not None:
+        start = time.time()
+        if cls is LxmlPlanter:
+            cls = _CountingLxmlPlanter
+        else:
+            cls = _CountingPlanter
+        tree = cls(impl, converters, stats).to_etree(*args)
+        stats.add_time('to_etree', time.time() - start)
+        return tree
+    if converters:
+        return cls(impl, converters).to_etree(*args)
+    planter = _planters.get(impl)
+    if planter is None:
+        planter = _planters[impl] = cls(impl)
+    return planter.to_etree(*args)
+
+
+def to_xmlfile(xf, struct, namespaces=None, converters=None):
+    '''
+    Writes plant to `xf`, opened `lxml.etree.xmlfile`, element by element.
+    Namespaces are declared on the root element, see `LxmlPlanter`.
+
+        with etree.xmlfile('out.xml', encoding='utf-8') as xf:
+            xf.write_declaration()
+            to_xmlfile(xf, plant)
+    '''
+    if converters:
+        planter = LxmlPlanter(None, converters)
+    else:
+        impl = _lxml()
+        planter = _planters.get(impl)
+        if planter is None:
+            planter = _planters[impl] = LxmlPlanter(impl)
+    planter.write(xf, struct, namespaces)
+
+
+class _Names(dict):
+    '''
+    Cache of etree names, `{uri}name` -> `qname`. Prefixes are taken from
+    `namespaces`, unknown namespaces get `ns0`, `ns1`... prefixes.
+    '''
+
+    def __init__(self, namespaces=None):
+        self.prefixes = dict((ns.uri, ns.prefix) for ns in namespaces or ())
+
+    def add_prefix(self, uri, prefix):
+        if uri in self.prefixes:
+            return
+        used = set(self.prefixes.values())
+        i = 0
+        while not prefix or prefix in used:
+            prefix = 'ns%d' % i
+            i += 1
+        self.prefixes[uri] = prefix
+
+    def __missing__(self, name):
+        if not isinstance(name, basestring):
+            # `impl.QName` instance
+            value = self[name] = self[name.text]
+            return value
+        if name[:1] == '{':
+            uri, local = name[1:].split('}', 1)
+            self.add_prefix(uri, None)
+            value = qname(local, uri, self.prefixes[uri])
+        else:
+            value = name
+        self[name] = value
+        return value
+
+
+def _from_element(element, names):
+    attrs = {}
+    for k, v in element.items():
+        attrs[names[k]] = v if isinstance(v, basestring) else names[v]
+    plant = [names[element.tag], attrs] if attrs else [names[element.tag]]
+    if element.text:
+        plant.append(element.text)
+    return plant
+
+
+def from_etree(element, namespaces=None, _names=None):
+    '''
+    Transforms etree `element` back to plant. `{uri}name` names become
+    qnames with prefixes from `namespaces` (list of `namespace` objects).
+    Comments and processing instructions are skipped.
+    '''
+    names = _Names(namespaces) if _names is None else _names
+    root = _from_element(element, names)
+    # explicit stack of [plant, children iterator, index in parent plant],
+    # plants are lists until all their children are seen
+    stack = [[root, iter(element), None]]
+    while stack:
+        plant, children, index = stack[-1]
+        for child in children:
+            # tags of comments and processing instructions are factories
+            is_element = not callable(child.tag)
+            if is_element:
+                node = _from_element(child, names)
+                stack.append([node, iter(child), len(plant)])
+                plant.append(node)
+            if child.tail:
+                plant.append(child.tail)
+            if is_element:
+                break
+        else:
+            stack.pop()
+            if stack:
+                stack[-1][0][index] = tuple(plant)
+    return tuple(root)
+
+
+def iter_plants(source, tag=None, namespaces=None, impl=ElementTree):
+    '''
+    Parses `source` (file name or file object) incrementally and yields
+    plants of elements with `tag` (name in `{uri}name` form or qname),
+    by default of children of the root element. Elements are cleared once
+    they are seen, so memory does not grow with the document size.
+    Namespace prefixes of the document are used for qnames, unless
+    `namespaces` are given for them.
+    '''
+    if isinstance(tag, qname):
+        tag = tag.clark
+    names = _Names(namespaces)
+    stack = []
+    match = None
+    for event, element in impl.iterparse(source,
+                                         events=('start', 'end', 'start-ns')):
+        if event == 'start-ns':
+            prefix, uri = element
+            names.add_prefix(uri, prefix)
+        elif event == 'start':
+            if match is None and (element.tag == tag if tag is not None
+                                  else len(stack) == 1):
+                match = element
+            stack.append(element)
+        else:
+            stack.pop()
+            if match is element:
+                match = None
+                yield from_etree(element, _names=names)
+            if match is None:
+                element.clear()
+                if stack:
+                    stack[-1].remove(element)
 
 
 class _sample_property(object):
@@ -162,6 +976,15 @@ class _sample_property(object):
     def __get__(self, inst, cls):
         if inst is None:
             return self
+        if cls._cache is not None:
+            return cls._cache.get(inst, self)
+        if cls._memo is not None:
+            result = cls._memo.get(inst, self)
+            # read by other attribute being computed, it is recorded as not
+            # overridden by the instance, so it is not stored
+            if not cls._memo.computing(inst):
+                setattr(inst, self.name, result)
+            return result
         result = self.method(inst)
         setattr(inst, self.name, result)
         return result
@@ -170,13 +993,278 @@ class _sample_property(object):
         return self.method(obj)
 
 
+class _SampleState(object):
+    '''Cached attributes of one `Sample` instance'''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # name -> (value, expiration time, `SampleMemo` inputs)
+        self.values = collections.OrderedDict()
+        # name -> names of attributes computed from it
+        self.dependents = {}
+        # attributes being computed by `owner` thread
+        self.stack = []
+        self.owner = None
+
+
+class SampleCache(object):
+    '''
+    Caching mode of `Sample` attributes, enabled by `_cache` class attribute:
+
+        class Envelope(Sample):
+            _cache = SampleCache(size=100, ttl=60)
+
+    Every attribute is computed once per instance, even when several threads
+    access it at the same time. At most `size` attributes per instance are
+    kept (least recently used are dropped), each for `ttl` seconds.
+    Attributes read while computing an attribute are recorded, so assigning
+    or invalidating one of them invalidates everything computed from it.
+    `hits` and `misses` are counted over all instances.
+    '''
+
+    def __init__(self, size=None, ttl=None, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _state(self, inst):
+        attrs = object.__getattribute__(inst, '__dict__')
+        state = attrs.get('_cache_state')
+        if state is None:
+            with self._lock:
+                state = attrs.setdefault('_cache_state', _SampleState())
+        return state
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, inst, prop):
+        '''Returns cached value of `prop` attribute, computes it if needed'''
+        state = self._state(inst)
+        name = prop.name
+        with state.lock:
+            entry = state.values.get(name)
+            if entry is not None and entry[1] is not None and \
+                    entry[1] <= self.clock():
+                self._invalidate(state, [name])
+                entry = None
+            memo = type(inst)._memo
+            if entry is not None:
+                if self.size:
+                    state.values[name] = state.values.pop(name)
+                self._count(True)
+                if memo is not None:
+                    memo.merge(inst, entry[2])
+                return entry[0]
+            self._count(False)
+            state.stack.append(name)
+            state.owner = thread.get_ident()
+            try:
+                if memo is not None:
+                    value, inputs = memo.compute(inst, prop)
+                    memo.merge(inst, inputs)
+                else:
+                    value, inputs = prop.method(inst), None
+            finally:
+                state.stack.pop()
+            expires = None if self.ttl is None else self.clock() + self.ttl
+            state.values[name] = value, expires, inputs
+            if self.size and len(state.values) > self.size:
+                state.values.popitem(last=False)
+            return value
+
+    def record(self, inst, name):
+        '''Records that `name` is read by attribute being computed'''
+        state = object.__getattribute__(inst, '__dict__').get('_cache_state')
+        if state is not None and state.stack and \
+                state.owner == thread.get_ident() and state.stack[-1] != name:
+            state.dependents.setdefault(name, set()).add(state.stack[-1])
+
+    def invalidate(self, inst, *names):
+        '''
+        Drops cached `names` (all attributes if none given) of `inst` and
+        attributes computed from them.
+        '''
+        state = self._state(inst)
+        with state.lock:
+            if names:
+                self._invalidate(state, names)
+            else:
+                state.values.clear()
+                state.dependents.clear()
+
+    def _invalidate(self, state, names):
+        names = list(names)
+        seen = set()
+        while names:
+            name = names.pop()
+            if name not in seen:
+                seen.add(name)
+                state.values.pop(name, None)
+                names.extend(state.dependents.pop(name, ()))
+
+
+_missing = object()
+
+
+class SampleMemo(object):
+    '''
+    Memoization of `Sample` attributes across instances, enabled by `_memo`
+    class attribute:
+
+        class Envelope(Sample):
+            _memo = SampleMemo(size=1000)
+
+    Instance attributes read by every method (directly or by other methods
+    it uses) are recorded, and its result is reused for any instance of the
+    class with equal values of them, so methods must not depend on anything
+    else. Results are shared, so they must not be modified. Inputs that are
+    not hashable turn memoization off for the method. At most `size`
+    results are kept, least recently used are dropped.
+    '''
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (class, name) -> list of tuples of input names seen
+        self._patterns = {}
+        # (class, name, input names, input values) -> result
+        self._results = collections.OrderedDict()
+        # stack of (instance, inputs) for attributes being computed
+        self._local = threading.local()
+
+    def _frames(self):
+        try:
+            return self._local.frames
+        except AttributeError:
+            frames = self._local.frames = []
+            return frames
+
+    def _lookup(self, inst, prop):
+        attrs = object.__getattribute__(inst, '__dict__')
+        cls_name = type(inst), prop.name
+        for names in self._patterns.get(cls_name, ()):
+            values = tuple(attrs.get(name, _missing) for name in names)
+            key = cls_name + (names, values)
+            with self._lock:
+                try:
+                    value = self._results.pop(key)
+                except (KeyError, TypeError):
+                    continue
+                self._results[key] = value
+                self.hits += 1
+            return value, dict(zip(names, values))
+        return _missing, None
+
+    def compute(self, inst, prop):
+        '''
+        Returns memoized or computed value of `prop` attribute of `inst`
+        and its inputs (dict of instance attributes it depends on).
+        '''
+        value, inputs = self._lookup(inst, prop)
+        if value is not _missing:
+            return value, inputs
+        frames = self._frames()
+        frames.append((inst, {}))
+        try:
+            value = prop.method(inst)
+        finally:
+            inputs = frames.pop()[1]
+        names = tuple(sorted(inputs))
+        key = (type(inst), prop.name, names,
+               tuple(inputs[name] for name in names))
+        with self._lock:
+            self.misses += 1
+            try:
+                self._results[key] = value
+            except TypeError:
+                return value, inputs
+            patterns = self._patterns.setdefault(key[:2], [])
+            if names not in patterns:
+                patterns.append(names)
+            if len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return value, inputs
+
+    def get(self, inst, prop):
+        value, inputs = self.compute(inst, prop)
+        self.merge(inst, inputs)
+        return value
+
+    def computing(self, inst):
+        '''Checks that an attribute of `inst` is being computed'''
+        frames = self._frames()
+        return bool(frames) and frames[-1][0] is inst
+
+    def merge(self, inst, inputs):
+        '''Adds `inputs` to inputs of attribute of `inst` being computed'''
+        frames = self._frames()
+        if frames and frames[-1][0] is inst:
+            frames[-1][1].update(inputs)
+
+    def record(self, inst, name):
+        '''Records that `name` is read by attribute being computed'''
+        frames = self._frames()
+        if frames and frames[-1][0] is inst:
+            frames[-1][1][name] = object.__getattribute__(
+                inst, '__dict__').get(name, _missing)
+
+
+# attributes of caching itself, reading them is not recorded
+_sample_bookkeeping = frozenset(['_cache', '_memo', '_cache_state'])
+
+
+# installed by `Sample` metaclass when caching or memoization is enabled,
+# subclass may turn it off again
+def _cached_getattribute(self, name):
+    cls = type(self)
+    try:
+        value = object.__getattribute__(self, name)
+    except AttributeError:
+        if cls._memo is not None and name[:2] != '__':
+            cls._memo.record(self, name)
+        raise
+    if name[:2] != '__':
+        if cls._cache is not None and name not in _sample_bookkeeping:
+            cls._cache.record(self, name)
+        if cls._memo is not None:
+            cls._memo.record(self, name)
+    return value
+
+
+def _cached_setattr(self, name, value):
+    object.__setattr__(self, name, value)
+    if type(self)._cache is not None:
+        type(self)._cache.invalidate(self, name)
+
+
+def _cached_delattr(self, name):
+    object.__delattr__(self, name)
+    if type(self)._cache is not None:
+        type(self)._cache.invalidate(self, name)
+
+
 class Sample(object):
     '''
     XML sample class with ability to override parts in subclasses or by initial
     parameters. Must be used when function is not enougth.
-    Every public method of instance became a cached attribute.
+    Every public method of instance became a cached attribute, see
+    `SampleCache` for thread-safe caching mode and `SampleMemo` for reusing
+    results across instances.
     '''
 
+    _cache = None
+    _memo = None
+
     class __metaclass__(type):
         def __new__(cls, cls_name, bases, attributes):
             self = type.__new__(cls, cls_name, bases, attributes)
@@ -193,6 +1281,10 @@ class Sample(object):
                 else:
                     continue
                 setattr(self, name, _sample_property(new_value, name=name))
+            if self._cache is not None or self._memo is not None:
+                self.__getattribute__ = _cached_getattribute
+                self.__setattr__ = _cached_setattr
+                self.__delattr__ = _cached_delattr
             return self
 
     def __init__(self, **kwargs):
@@ -206,85 +1298,1236 @@ def timestamp(dt):
     return dt.strftime('%Y-%m-%dT%H:%M:%S') + tz
 
 
+def _escape(text):
+    '''The same as `xml.sax.saxutils.escape`'''
+    # str.replace returns the same string if there is nothing to replace
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _quote(value):
+    '''The same as `xml.sax.saxutils.quoteattr`'''
+    value = value.replace('&', '&amp;').replace('<', '&lt;') \
+                 .replace('>', '&gt;').replace('\n', '&#10;') \
+                 .replace('\r', '&#13;').replace('\t', '&#9;')
+    if '"' in value:
+        if "'" in value:
+            return '"%s"' % value.replace('"', '&quot;')
+        return "'%s'" % value
+    return '"%s"' % value
+
+
+class _EscapeCache(dict):
+    '''
+    Escaped values of short strings, which tend to repeat (enum-like
+    attribute values, numbers, flags). Cache is dropped as a whole when it
+    has `size` items.
+    '''
+
+    max_length = 64
+
+    def __init__(self, escape, size):
+        self.escape = escape
+        self.size = size
+
+    def __missing__(self, value):
+        escaped = self.escape(value)
+        if self.size:
+            if len(self) >= self.size:
+                self.clear()
+            self[value] = escaped
+        return escaped
+
+
+_text_cache = _EscapeCache(_escape, 1024)
+_attr_cache = _EscapeCache(_quote, 1024)
+
+
+def set_escape_cache(text_size=1024, attr_size=1024):
+    '''
+    Sets sizes of escaped text and attribute values caches, `0` disables
+    cache. Only strings up to 64 bytes are cached.
+    '''
+    for cache, size in [(_text_cache, text_size), (_attr_cache, attr_size),
+                        (_c14n_attr_cache, attr_size)]:
+        cache.clear()
+        cache.size = size
+
+
+def _escape_cdata(text):
+    if isinstance(text, safe):
+        return text
+    if _text_cache.size and len(text) <= _EscapeCache.max_length:
+        return _text_cache[text]
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _quote_attr(value):
+    if isinstance(value, safe):
+        return value
+    if _attr_cache.size and len(value) <= _EscapeCache.max_length:
+        return _attr_cache[value]
+    return _quote(value)
+
+
 def _escape_text(text):
     if isinstance(text, safe):
         return text
-    return safe(escape(text))
+    return safe(_escape_cdata(text))
 
 
 def _escape_attr(attr):
     if isinstance(attr, safe):
         return attr
-    return safe(quoteattr(attr))
+    return safe(_quote_attr(attr))
 
 
 class safe(str): pass
 
 
+class fragment(safe):
+    '''
+    Already encoded (utf-8) xml: elements, optionally with text around them.
+    `encode` writes it as is, `to_etree` parses it once per implementation
+    and inserts copies of parsed elements. Namespace prefixes used in it
+    must be declared inside.
+    '''
+
+    @classmethod
+    def from_plant(cls, struct, indent=0, namespaces=None):
+        '''Encodes `struct` (with its namespace declarations) to fragment'''
+        return cls(encode(struct, indent=indent, namespaces=namespaces)
+                   [len(_xml_declaration(None)):])
+
+    def to_etree(self, impl=ElementTree):
+        '''Returns text before the first element and list of new elements'''
+        parsed = self.__dict__.setdefault('_parsed', {})
+        try:
+            text, elements = parsed[impl]
+        except KeyError:
+            root = impl.fromstring('<fragment>%s</fragment>' % self)
+            text, elements = parsed[impl] = root.text, list(root)
+        if impl.__name__.startswith('xml.etree.'):
+            # parsed elements are kept, so copies must share no descendants
+            copies = [_clone_etree(e, impl) for e in elements]
+            for element, new_element in zip(elements, copies):
+                new_element.tail = element.tail
+            return text, copies
+        return text, [copy.deepcopy(e) for e in elements]
+
+
+class _Codec(object):
+    '''
+    Encodes markup and content of one document to `encoding`. Tags are
+    encoded once per tag name. `str` values are considered utf-8, for utf-8
+    output they are written as is.
+    '''
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self.utf8 = codecs.lookup(encoding).name == 'utf-8'
+        if not self.utf8:
+            # incremental encoder writes BOM (if any) only once
+            self._encoder = codecs.getincrementalencoder(encoding)()
+        self._start_tags = {}
+        self._empty_tags = {}
+        self._end_tags = {}
+        self._open_tags = {}
+        self._attr_names = {}
+
+    def encode(self, text, errors='strict'):
+        if self.utf8:
+            if isinstance(text, unicode):
+                return text.encode('utf-8')
+            return text
+        if isinstance(text, str):
+            text = text.decode('utf-8')
+        self._encoder.errors = errors
+        return self._encoder.encode(text)
+
+    def text(self, text):
+        if self.utf8:
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            return _escape_cdata(text)
+        if not isinstance(text, safe):
+            if isinstance(text, str):
+                text = text.decode('utf-8')
+            text = _escape(text)
+        return self.encode(text, 'xmlcharrefreplace')
+
+    def attr_value(self, value):
+        if self.utf8:
+            return _encode_attr_value(value)
+        if not isinstance(value, safe):
+            if isinstance(value, str):
+                value = value.decode('utf-8')
+            value = _quote(unicode(value))
+        return self.encode(value, 'xmlcharrefreplace')
+
+    def start_tag(self, name, attrs, empty):
+        if not attrs:
+            tags = self._empty_tags if empty else self._start_tags
+            try:
+                return tags[name]
+            except KeyError:
+                tag = tags[name] = self.encode(
+                    ('<%s/>' if empty else '<%s>') % name)
+                return tag
+        try:
+            out = [self._open_tags[name]]
+        except KeyError:
+            out = [self._open_tags.setdefault(name, self.encode('<'+name))]
+        for k, v in sorted(attrs.items()):
+            try:
+                out.append(self._attr_names[k])
+            except KeyError:
+                out.append(self._attr_names.setdefault(
+                    k, self.encode(' %s=' % k)))
+            out.append(self.attr_value(v))
+        out.append(self.encode('/>' if empty else '>'))
+        return ''.join(out)
+
+    def end_tag(self, name):
+        try:
+            return self._end_tags[name]
+        except KeyError:
+            tag = self._end_tags[name] = self.encode('</%s>' % name)
+            return tag
+
+
+class _CountingCodec(_Codec):
+    '''`_Codec` that counts tags, attributes and escaped bytes'''
+
+    def __init__(self, encoding, stats):
+        _Codec.__init__(self, encoding)
+        self.stats = stats
+
+    def text(self, text):
+        result = _Codec.text(self, text)
+        if not isinstance(text, safe):
+            self.stats.escaped_bytes += len(result)
+        return result
+
+    def attr_value(self, value):
+        self.stats.count_converter(type(value))
+        value = _Codec.attr_value(self, value)
+        # without quotes
+        self.stats.escaped_bytes += len(value) - 2
+        return value
+
+    def start_tag(self, name, attrs, empty):
+        self.stats.nodes += 1
+        self.stats.attributes += len(attrs)
+        return _Codec.start_tag(self, name, attrs, empty)
+
+
+class _Pending(object):
+    '''
+    Yielded by encoder instead of a pending child, its `value` must be set
+    before the encoder is resumed. Its length makes chunks flushed before it.
+    '''
+
+    def __init__(self, child):
+        self.child = child
+        self.value = None
+
+    def __len__(self):
+        return sys.maxint
+
+
+def _iter_encode_tag(struct, indent=2, level=0, namespaces=None,
+                     declare=True, codec=None, pending=None):
+    '''
+    Yields encoded pieces of `struct` one by one. Uses an explicit stack
+    instead of recursion, so no intermediate strings are built per level.
+    If `namespaces` dict is given, namespaces of all qnames are collected into
+    it during the same walk (or checked against it if `declare` is false).
+    Children for which `pending(child)` is true are yielded as `_Pending`.
+    '''
+    if codec is None:
+        codec = _Codec()
+    encode = codec.encode
+    stack = []
+    while True:
+        name, attrs, children = _unpack(struct)
+        if namespaces is not None:
+            for n in [name]+attrs.keys():
+                if isinstance(n, qname):
+                    _update_namespace(namespaces, n.uri, 'xmlns:'+n.prefix,
+                                      declare)
+        if indent and level:
+            yield encode('\n' + ' '*indent*level)
+        # next child is fetched in advance, so lazy children need no length
+        child, children = _next_child(iter(children))
+        yield codec.start_tag(name, attrs, child is _end)
+        if child is not _end:
+            stack.append([name, level, children, child])
+        # `closed` means that last child of the frame on top is a closed tag
+        closed = child is _end
+        while stack:
+            frame = stack[-1]
+            name, level, children, child = frame
+            if closed:
+                if indent and child is _end:
+                    yield encode('\n')
+                yield encode(' '*indent*level)
+                closed = False
+            if child is _end:
+                stack.pop()
+                yield codec.end_tag(name)
+                closed = True
+                continue
+            frame[3] = next(children, _end)
+            if type(frame[3]) not in _plain_children and \
+                    frame[3] is not _end and _is_lazy(frame[3]):
+                frame[2] = _splice(children, frame[3])
+                frame[3] = next(frame[2], _end)
+            if isinstance(child, basestring):
+                yield codec.text(child)
+            elif pending is not None and pending(child):
+                wait = _Pending(child)
+                yield wait
+                # resolved value is spliced in place of the child
+                rest = [] if frame[3] is _end else [frame[3]]
+                frame[2] = _splice(frame[2], [wait.value], rest)
+                frame[3] = next(frame[2], _end)
+            else:
+                struct, level = child, level+1 if indent else 0
+                break
+        else:
+            return
+
+
 def _encode_tag(struct, indent=2, level=0):
-    name, attrs, children = _unpack(struct)
-    start_name = name
-    if attrs:
-        start_name = '%s %s' % (name, _encode_attrs(attrs))
+    return safe(''.join(_iter_encode_tag(struct, indent=indent, level=level)))
+
+
+def _xml_declaration(encoding):
+    if encoding is None:
+        return '<?xml version="1.0"?>\n'
+    return '<?xml version="1.0" encoding="%s"?>\n' % encoding
+
+
+def _buffer_namespaces(buffer, namespaces):
+    '''Returns namespaces to declare for `PlantBuffer`, checks its qnames'''
+    if namespaces is None:
+        declared = {}
+        for n in buffer.qnames():
+            _update_namespace(declared, n.uri, 'xmlns:'+n.prefix)
+        return declared
+    declared = dict(('xmlns:'+ns.prefix, ns.uri) for ns in namespaces)
+    check = dict(declared)
+    for n in buffer.qnames():
+        _update_namespace(check, n.uri, 'xmlns:'+n.prefix, False)
+    return declared
+
+
+class EncodeCache(object):
+    '''
+    Output cache of repeated subtrees for `encode`, pass it as `cache`:
+
+        cache = EncodeCache(size=1000)
+        body = encode(plant, cache=cache)
+
+    Subtrees are looked up by value, so equal tuples built separately share
+    an entry, and the cache can be shared by documents and threads. Only
+    immutable subtrees are cached: tuples of strings, qnames and such
+    tuples, without attributes (dicts) and lazy children. Children of other
+    subtrees are still looked up, unless they are nested in `max_nesting`
+    subtrees that missed, so every node is hashed a bounded number of times
+    however deep the plant is. Output is kept per encoding and indentation
+    level together with namespaces used in it.
+    A subtree is kept when it is seen the second time and its output is at
+    least `min_bytes` long, so unique and small subtrees are encoded as
+    usual. At most `size` subtrees and `max_bytes` of output are kept,
+    least recently used are dropped. `hits` and `misses` count lookups,
+    `bytes` is size of kept output.
+    '''
+
+    def __init__(self, size=1024, max_bytes=1024*1024, min_bytes=64,
+                 max_nesting=8):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self.max_nesting = max_nesting
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        # hash of (subtree, encoding, indent, level) -> (key, output,
+        # namespaces)
+        self._entries = collections.OrderedDict()
+        # hashes of keys seen once, dropped as a whole when it is too large
+        self._seen = set()
+
+    def _get(self, key):
+        '''
+        Returns (output, namespaces) of subtree `key[0]`, `None` if it is
+        not kept or `_record` if it should be kept after encoding. Raises
+        `TypeError` if subtree is not hashable.
+        '''
+        # entries are keyed by hash, so the subtree is hashed once
+        hashed = hash(key)
+        entry = self._entries.get(hashed)
+        if entry is not None and not (
+                entry[0][1:] == key[1:] and _same_plant(entry[0][0], key[0])):
+            # other key with the same hash, or equal subtree encoded
+            # differently (`safe` and `str`, qnames of other namespaces
+            # with the same prefix)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                if hashed in self._seen:
+                    return _record
+                if len(self._seen) >= self.size * 16:
+                    self._seen.clear()
+                self._seen.add(hashed)
+                return None
+            self.hits += 1
+            if self._entries.get(hashed) is entry:
+                self._entries[hashed] = self._entries.pop(hashed)
+        return entry[1:]
+
+    def _put(self, key, output, namespaces):
+        if not self.min_bytes <= len(output) <= self.max_bytes:
+            return
+        hashed = hash(key)
+        with self._lock:
+            old = self._entries.pop(hashed, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            self._entries[hashed] = key, output, namespaces
+            self.bytes += len(output)
+            while len(self._entries) > self.size or \
+                    self.bytes > self.max_bytes:
+                self.bytes -= len(self._entries.popitem(last=False)[1][1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._seen.clear()
+            self.bytes = 0
+
+
+_record = object()
+
+
+def _same_plant(a, b):
+    '''
+    Checks that plants `a` and `b` are equal and have the same types of
+    nodes, compared with explicit stack, so depth is not limited.
+    '''
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if a is b:
+            continue
+        if type(a) is not type(b):
+            return False
+        if type(a) is tuple:
+            if len(a) != len(b):
+                return False
+            stack.extend(zip(a, b))
+        elif a != b or type(a) is qname and a.uri != b.uri:
+            return False
+    return True
+
+
+def _encode_cached(struct, indent, namespaces, declare, codec, cache):
+    '''
+    `_iter_encode_tag` that looks up output of subtrees in `cache`
+    (`EncodeCache`) and stores missed ones. Returns list of pieces, the
+    output of a subtree is a slice of it. Root tag is not looked up.
+    '''
+    encode = codec.encode
+    max_nesting = cache.max_nesting
     out = []
-    write = out.append
-    def do_indent(newline=True):
-        if indent and newline:
-            write('\n')
-        write(' '*indent*level)
-    do_indent(newline=level)
-    if children:
-        write('<%s>' % start_name)
-        children_count = len(children)
-        for i, child in enumerate(children):
-            if isinstance(child, str):
-                write(_escape_text(child))
-            elif isinstance(child, unicode):
-                write(_escape_text(child.encode('utf-8')))
-            else:
-                write(_encode_tag(child,
-                                 indent=indent,
-                                 level=level+1 if indent else 0))
-                do_indent(newline=i==children_count-1)
-        write('</%s>' % name)
+    # (prefix, uri) of qnames in order of appearance, slices of it are
+    # namespaces of subtrees
+    used = []
+    stack = []
+    # frames below `cleared` have no records
+    cleared = 0
+    # `nesting` is number of subtrees looked up on the way to the frame
+    level, key, nesting = 0, None, 0
+    while True:
+        # subtree is recorded as (key, start of output, start of namespaces)
+        record = None if key is None else (key, len(out), len(used))
+        name, attrs, children = _unpack(struct)
+        for n in [name]+attrs.keys():
+            if isinstance(n, qname):
+                prefix = 'xmlns:'+n.prefix
+                _update_namespace(namespaces, n.uri, prefix, declare)
+                used.append((prefix, n.uri))
+        if indent and level:
+            out.append(encode('\n' + ' '*indent*level))
+        child, children = _next_child(iter(children))
+        out.append(codec.start_tag(name, attrs, child is _end))
+        if child is not _end:
+            stack.append([name, level, children, child, record, nesting])
+            if type(children) is _Children:
+                # lazy children are spliced in by `_next_child`, their
+                # output can not be reused
+                for other in stack[cleared:]:
+                    other[4] = None
+                cleared = len(stack)
+        closed = child is _end
+        while stack:
+            frame = stack[-1]
+            name, level, children, child, record, nesting = frame
+            if closed:
+                if indent and child is _end:
+                    out.append(encode('\n'))
+                out.append(encode(' '*indent*level))
+                closed = False
+            if child is _end:
+                stack.pop()
+                cleared = min(cleared, len(stack))
+                out.append(codec.end_tag(name))
+                if record is not None:
+                    key, start, seen = record
+                    cache._put(key, safe(''.join(out[start:])),
+                               frozenset(used[seen:]))
+                closed = True
+                continue
+            frame[3] = next(children, _end)
+            if type(frame[3]) not in _plain_children and \
+                    frame[3] is not _end and _is_lazy(frame[3]):
+                frame[2] = _splice(children, frame[3])
+                frame[3] = next(frame[2], _end)
+                for other in stack[cleared:]:
+                    other[4] = None
+                cleared = len(stack)
+            if isinstance(child, basestring):
+                out.append(codec.text(child))
+                continue
+            level = level+1 if indent else 0
+            key = None
+            # leaves are cheaper to encode than to look up
+            if nesting < max_nesting and \
+                    type(child) is tuple and len(child) > 1 and \
+                    (type(child[1]) is tuple or
+                     len(child) > 2 and tuple in map(type, child)) and \
+                    not isinstance(child[1], dict):
+                nesting += 1
+                key = child, codec.encoding, indent, level
+                try:
+                    hit = cache._get(key)
+                except TypeError:
+                    hit = None
+                if hit is None:
+                    key = None
+                elif hit is not _record:
+                    output, names = hit
+                    for prefix, uri in names:
+                        _update_namespace(namespaces, uri, prefix, declare)
+                    used.extend(names)
+                    out.append(output)
+                    closed = True
+                    continue
+            struct = child
+            break
+        else:
+            return out
+
+
+class Digests(object):
+    '''
+    Digests of marked subtrees computed while a plant is encoded in
+    canonical form, pass it as `digests` to `encode`, `encode_iter` or
+    `encode_to`, e.g. for references of WS-Security signature:
+
+        digests = Digests([body, timestamp], algorithm='sha256')
+        message = encode(envelope, digests=digests)
+        digest_value = base64.b64encode(digests[body])
+
+    Subtrees are marked by identity. Digest of a subtree is computed over
+    its exclusive canonical form (as if it was the root, with namespaces it
+    uses declared on it), which is built piece by piece together with the
+    output, so the document is serialized only once.
+    '''
+
+    def __init__(self, subtrees, algorithm='sha1'):
+        # fails early for unknown algorithm
+        hashlib.new(algorithm)
+        self.algorithm = algorithm
+        # marked subtrees are kept, so their ids are not reused
+        self._marked = dict((id(subtree), subtree) for subtree in subtrees)
+        self._digests = {}
+
+    def __getitem__(self, subtree):
+        '''Returns digest (bytes) of written `subtree`'''
+        return self._digests[id(subtree)]
+
+
+_xml_namespace = 'http://www.w3.org/XML/1998/namespace'
+
+
+def _c14n_text(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    elif isinstance(text, safe):
+        return text
+    if '\r' in text:
+        return _escape(text).replace('\r', '&#xD;')
+    return _escape_cdata(text)
+
+
+def _c14n_quote(value):
+    return '"%s"' % value.replace('&', '&amp;').replace('<', '&lt;') \
+                         .replace('"', '&quot;').replace('\t', '&#x9;') \
+                         .replace('\n', '&#xA;').replace('\r', '&#xD;')
+
+
+_c14n_attr_cache = _EscapeCache(_c14n_quote, 1024)
+
+
+def _c14n_attr(value):
+    # `safe` values are quoted and escaped, as by `_encode_attr_value`
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    if _c14n_attr_cache.size and len(value) <= _EscapeCache.max_length:
+        return _c14n_attr_cache[value]
+    return _c14n_quote(value)
+
+
+def _c14n_attr_key(name):
+    '''Canonical order of attributes: by namespace uri and local name'''
+    if isinstance(name, qname):
+        return name.uri, name.name
+    return '', name
+
+
+def _iter_encode_canonical(struct, namespaces=None, digests=None):
+    '''
+    Yields pieces of canonical form (Canonical XML 1.0 without comments)
+    of `struct`: utf-8, no declaration, attributes in canonical order,
+    empty elements as start and end tags. Namespaces are declared on
+    elements that use them, unless an ancestor declares them, as exclusive
+    canonicalization renders them. If `namespaces` dict is given, qnames
+    are checked against it. `safe` strings (fragments) are written as is,
+    so they must be canonical. Digests of subtrees marked in `digests` are
+    updated with pieces of their own canonical form as they are written,
+    it differs from the output only by namespace declarations.
+    '''
+    encode = _Codec().encode
+    marked = {} if digests is None else digests._marked
+    # name -> encoded name and namespace it uses (prefix, uri) or None
+    names = {}
+    stack = []
+    # prefix -> uri declared in output and in every marked subtree being
+    # written, with hashers of the latter
+    contexts, hashers = [{}], []
+    while True:
+        name, attrs, children = _unpack(struct)
+        key = id(struct)
+        if key in marked:
+            contexts = contexts + [{}]
+            hashers = hashers + [hashlib.new(digests.algorithm)]
+        else:
+            key = None
+        try:
+            tag, used = names[name]
+        except KeyError:
+            used = None
+            if isinstance(name, qname) and name.uri != _xml_namespace:
+                if namespaces is not None:
+                    _update_namespace(namespaces, name.uri,
+                                      'xmlns:'+name.prefix, False)
+                used = name.prefix, name.uri
+            tag, used = names[name] = encode(name), used
+        used = dict([used]) if used else {}
+        if attrs:
+            for n in attrs:
+                if isinstance(n, qname) and n.uri != _xml_namespace:
+                    if namespaces is not None:
+                        _update_namespace(namespaces, n.uri,
+                                          'xmlns:'+n.prefix, False)
+                    _update_namespace(used, n.uri, n.prefix)
+            rest = ''.join([' %s=%s' % (encode(k), _c14n_attr(attrs[k]))
+                            for k in sorted(attrs, key=_c14n_attr_key)] +
+                           ['>'])
+        else:
+            rest = '>'
+        start = '<' + tag + rest
+        # start tags differ by declarations of namespaces in contexts
+        starts = None
+        for i, context in enumerate(contexts if used else ()):
+            new = [(prefix, uri) for prefix, uri in used.items()
+                   if context.get(prefix) != uri]
+            if new:
+                if starts is None:
+                    starts, contexts = [start] * len(contexts), list(contexts)
+                new.sort()
+                context = contexts[i] = dict(context)
+                context.update(new)
+                starts[i] = ''.join(
+                    ['<', tag] +
+                    [' xmlns:%s=%s' % (encode(prefix), _c14n_attr(uri))
+                     for prefix, uri in new] +
+                    [rest])
+        if starts is None:
+            for hasher in hashers:
+                hasher.update(start)
+        else:
+            start = starts[0]
+            for hasher, piece in zip(hashers, starts[1:]):
+                hasher.update(piece)
+        yield start
+        stack.append([tag, iter(children), contexts, hashers, key])
+        while stack:
+            frame = stack[-1]
+            child, frame[1] = _next_child(frame[1])
+            tag, children, contexts, hashers, key = frame
+            if child is _end:
+                stack.pop()
+                piece = '</%s>' % tag
+                for hasher in hashers:
+                    hasher.update(piece)
+                if key is not None:
+                    digests._digests[key] = hashers[-1].digest()
+                yield piece
+                continue
+            if isinstance(child, basestring):
+                piece = _c14n_text(child)
+                for hasher in hashers:
+                    hasher.update(piece)
+                yield piece
+                continue
+            struct = child
+            break
+        else:
+            return
+
+
+def _iter_canonical(struct, indent, namespaces, encoding, digests):
+    '''Checks arguments of encoders in canonical mode'''
+    if indent:
+        raise ValueError('Canonical form is not indented')
+    if encoding is not None and codecs.lookup(encoding).name != 'utf-8':
+        raise ValueError('Canonical form is encoded to utf-8')
+    if isinstance(struct, PlantBuffer):
+        raise ValueError('Canonical form of PlantBuffer is not supported')
+    if namespaces is not None:
+        namespaces = dict(('xmlns:'+ns.prefix, ns.uri) for ns in namespaces)
+    return _iter_encode_canonical(struct, namespaces, digests)
+
+
+def _iter_encode(struct, indent=0, namespaces=None, encoding=None,
+                 codec=None, stats=None, pending=None, cache=None):
+    if isinstance(struct, PlantBuffer):
+        if codec is None:
+            codec = _Codec(encoding or 'utf-8')
+        yield codec.encode(_xml_declaration(encoding))
+        for piece in _iter_encode_buffer(
+                struct, indent, codec, _buffer_namespaces(struct, namespaces)):
+            yield piece
+        return
+    if namespaces is None:
+        start = time.time()
+        declared = _SinglePassCollector().visit(struct).namespaces
+        if stats is not None:
+            stats.add_time('namespaces', time.time() - start)
+    else:
+        declared = dict(('xmlns:'+ns.prefix, ns.uri) for ns in namespaces)
+    struct = update_tag(struct, attrs=declared)
+    if codec is None:
+        codec = _Codec(encoding or 'utf-8')
+    yield codec.encode(_xml_declaration(encoding))
+    if cache is not None:
+        pieces = _encode_cached(struct, indent, dict(declared), False, codec,
+                                cache)
     else:
-        write('<%s/>' % start_name)
-    return safe(''.join(out))
+        pieces = _iter_encode_tag(struct, indent=indent,
+                                  namespaces=None if namespaces is None
+                                             else dict(declared),
+                                  declare=False, codec=codec,
+                                  pending=pending)
+    for piece in pieces:
+        yield piece
+
+
+def _encode_pieces(struct, indent, namespaces, encoding, codec, stats=None,
+                   cache=None):
+    if namespaces is not None or isinstance(struct, PlantBuffer):
+        return list(_iter_encode(struct, indent=indent, namespaces=namespaces,
+                                 encoding=encoding, codec=codec, stats=stats,
+                                 cache=cache))
+    pieces = [codec.encode(_xml_declaration(encoding))]
+    collected = {}
+    if cache is not None:
+        pieces.extend(_encode_cached(struct, indent, collected, True, codec,
+                                     cache))
+    else:
+        pieces.extend(_iter_encode_tag(struct, indent=indent,
+                                       namespaces=collected, codec=codec))
+    if collected:
+        # root start tag always follows the declaration, it is empty if
+        # nothing follows it; the tag is not counted as a node again
+        name, attrs, children = _unpack(struct)
+        attrs.update(collected)
+        pieces[1] = _Codec.start_tag(codec, name, attrs, len(pieces) == 2)
+    return pieces
 
 
-def encode(struct, indent=0):
+def encode(struct, indent=0, namespaces=None, encoding=None, stats=None,
+           cache=None, canonical=False, digests=None):
     '''
     Optional independent implementation data -> str encoding.
+    Namespaces are collected in the same pass that encodes the structure.
+    If `namespaces` (a list of `namespace` objects) is given, they are
+    declared on the root tag and every qname must belong to one of them.
+    If `encoding` is given, it is used for output and declared in xml
+    declaration, characters it can not represent are written as character
+    references. Default is utf-8 without declaration.
+    If `stats` (`Stats` instance) is given, encoding is counted and timed.
+    If `cache` (`EncodeCache` instance) is given, output of repeated
+    subtrees is reused, nodes in them are not counted by `stats`.
+    If `canonical` is true, output is canonical form of the document (see
+    `_iter_encode_canonical`), it is not indented and is encoded to utf-8.
+    `digests` (`Digests` instance) implies canonical form.
     '''
-    namespaces = NamespaceCollector().visit(struct).namespaces
-    struct = update_tag(struct, attrs=namespaces)
-    return '<?xml version="1.0"?>\n%s' % _encode_tag(struct, indent=indent)
+    if canonical or digests is not None:
+        result = str(''.join(_iter_canonical(struct, indent, namespaces,
+                                             encoding, digests)))
+        if stats is not None:
+            stats.output_bytes += len(result)
+        return result
+    if stats is None:
+        return str(''.join(_encode_pieces(struct, indent, namespaces,
+                                          encoding,
+                                          _Codec(encoding or 'utf-8'),
+                                          cache=cache)))
+    codec = _CountingCodec(encoding or 'utf-8', stats)
+    scanned = stats.timings.get('namespaces', 0)
+    start = time.time()
+    pieces = _encode_pieces(struct, indent, namespaces, encoding, codec,
+                            stats, cache)
+    scanned = stats.timings.get('namespaces', 0) - scanned
+    stats.add_time('encode', time.time() - start - scanned)
+    start = time.time()
+    result = str(''.join(pieces))
+    stats.add_time('join', time.time() - start)
+    stats.output_bytes += len(result)
+    return result
+
+
+# children of the root tag for `encode_parallel` workers forked by default
+# pool, so that tasks are slices and plant is not pickled. It is set only in
+# workers, by pool initializer, so calls from several threads do not mix
+_forked_children = None
+
+
+def _init_forked(children):
+    '''Pool initializer of `encode_parallel` workers'''
+    global _forked_children
+    _forked_children = children
+
+
+def _encode_children(args):
+    '''Encodes a chunk of root children, runs in `encode_parallel` worker'''
+    children, indent, namespaces, encoding, last = args
+    if isinstance(children, slice):
+        children = _forked_children[children]
+    codec = _Codec(encoding or 'utf-8')
+    # BOM (if any) is written with xml declaration by the main process
+    codec.encode(u'')
+    out = []
+    for i, child in enumerate(children):
+        if isinstance(child, basestring):
+            out.append(codec.text(child))
+            continue
+        out.extend(_iter_encode_tag(child, indent=indent,
+                                    level=1 if indent else 0,
+                                    namespaces=namespaces, declare=False,
+                                    codec=codec))
+        if indent and last and i == len(children)-1:
+            out.append(codec.encode('\n'))
+    return ''.join(out)
 
 
-def _encode_attrs(attrs):
-    out = []
-    write = out.append
-    for k, v in sorted(attrs.items()):
-        if isinstance(v, unicode):
-            v = v.encode('utf-8')
-        write(u'%s=%s' % (k, _escape_attr(str(v))))
-    return ' '.join(out)
+def encode_parallel(struct, indent=0, namespaces=None, encoding=None,
+                    workers=None, chunk_size=1000, pool=None):
+    '''
+    The same as `encode`, but children of the root tag are encoded in
+    parallel, `chunk_size` children per task. Namespaces are collected
+    before encoding, so they are declared on the root tag as usual.
+    `pool` is any object with `map` method (`multiprocessing` pool,
+    `concurrent.futures` executor), by default `multiprocessing.Pool` of
+    `workers` processes is used. Tasks are pickled, so with processes it
+    pays off only for large documents. `PlantBuffer` is encoded by `encode`.
+    Lazy children of the root are consumed before encoding, lazy children
+    below them are consumed by tasks and require `namespaces` to be passed,
+    as for `encode_iter`.
+    '''
+    if isinstance(struct, PlantBuffer):
+        return encode(struct, indent, namespaces, encoding)
+    name, attrs, children = _unpack(struct)
+    # root children are chunked, so lazy ones are consumed here
+    children = tuple(_iter_children(children))
+    if namespaces is None:
+        declared = _SinglePassCollector().visit(
+            (name, attrs) + children).namespaces
+        check = None
+    else:
+        declared = dict(('xmlns:'+ns.prefix, ns.uri) for ns in namespaces)
+        check = declared
+        for n in [name]+attrs.keys():
+            if isinstance(n, qname):
+                _update_namespace(check, n.uri, 'xmlns:'+n.prefix, False)
+    attrs.update(declared)
+    codec = _Codec(encoding or 'utf-8')
+    pieces = [codec.encode(_xml_declaration(encoding)),
+              codec.start_tag(name, attrs, not children)]
+    if children:
+        fork = pool is None and hasattr(os, 'fork')
+        tasks = [(slice(i, i+chunk_size) if fork else children[i:i+chunk_size],
+                  indent, check, encoding, i+chunk_size >= len(children))
+                 for i in xrange(0, len(children), chunk_size)]
+        if pool is None:
+            # initializer arguments are inherited by forked workers, not
+            # pickled
+            own_pool = multiprocessing.Pool(
+                workers, initializer=_init_forked,
+                initargs=(children if fork else None,))
+            try:
+                pieces.extend(own_pool.map(_encode_children, tasks))
+            finally:
+                own_pool.close()
+                own_pool.join()
+        else:
+            pieces.extend(pool.map(_encode_children, tasks))
+        pieces.append(codec.end_tag(name))
+    return str(''.join(pieces))
+
+
+def encode_iter(struct, indent=0, chunk_size=65536, namespaces=None,
+                encoding=None, stats=None, canonical=False, digests=None):
+    '''
+    Streaming version of `encode`. Yields `str` chunks of about `chunk_size`
+    bytes, joined together they are equal to `encode(struct, indent)`.
+    Root tag is written before the rest of the structure is seen, so without
+    `namespaces` declared upfront there is an extra pass to collect them.
+    Lazy children (generators, iterators) are consumed while encoding and
+    require `namespaces` to be passed. `stats` are counted as for `encode`,
+    only namespace collection is timed. Canonical form is written as by
+    `encode`, it needs no extra pass, and `digests` are computed when the
+    marked subtrees are written.
+    '''
+    if canonical or digests is not None:
+        for chunk in _chunked(_iter_canonical(struct, indent, namespaces,
+                                              encoding, digests),
+                              chunk_size):
+            if stats is not None:
+                stats.output_bytes += len(chunk)
+            yield chunk
+        return
+    if stats is not None:
+        codec = _CountingCodec(encoding or 'utf-8', stats)
+        for chunk in _iter_chunks(struct, indent, chunk_size, namespaces,
+                                  encoding, codec, stats):
+            stats.output_bytes += len(chunk)
+            yield chunk
+        return
+    for chunk in _iter_chunks(struct, indent, chunk_size, namespaces,
+                              encoding):
+        yield chunk
+
+
+def _iter_chunks(struct, indent, chunk_size, namespaces, encoding,
+                 codec=None, stats=None, pending=None):
+    return _chunked(_iter_encode(struct, indent=indent, namespaces=namespaces,
+                                 encoding=encoding, codec=codec, stats=stats,
+                                 pending=pending),
+                    chunk_size)
+
+
+def _chunked(pieces, chunk_size):
+    '''Joins `pieces` to chunks of about `chunk_size` bytes'''
+    chunk = []
+    size = 0
+    for piece in pieces:
+        if len(piece) >= chunk_size:
+            # large pieces (fragments) are written without copying
+            if chunk:
+                yield str(''.join(chunk))
+                chunk = []
+                size = 0
+            yield piece
+            continue
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield str(''.join(chunk))
+            chunk = []
+            size = 0
+    if chunk:
+        yield str(''.join(chunk))
+
+
+def encode_to(fp, struct, indent=0, chunk_size=65536, namespaces=None,
+              encoding=None, stats=None, canonical=False, digests=None):
+    '''
+    Writes `encode(struct, indent)` to file-like object `fp` chunk by chunk.
+    '''
+    for chunk in encode_iter(struct, indent=indent, chunk_size=chunk_size,
+                             namespaces=namespaces, encoding=encoding,
+                             stats=stats, canonical=canonical,
+                             digests=digests):
+        fp.write(chunk)
+
+
+def encode_to_stream(write, struct, indent=0, chunk_size=65536,
+                     namespaces=None, encoding=None, pending=None):
+    '''
+    Generator-based coroutine for event loops (`tornado.gen.coroutine`,
+    `twisted.internet.defer.inlineCallbacks`), writes `encode(struct,
+    indent)` with `write(chunk)` chunk by chunk. Whatever `write` returns
+    (e.g. a future of flushing the stream) is yielded to the loop, so
+    encoding waits for slow clients and other requests are served between
+    chunks. Children for which `pending(child)` is true (e.g. futures) are
+    yielded to the loop too and replaced with their results, which can be
+    lazy children as well. `namespaces` must be passed for such plants.
+
+        @gen.coroutine
+        def get(self):
+            write = lambda chunk: self.write(chunk) or self.flush()
+            yield gen.coroutine(encode_to_stream)(write, plant,
+                                                   namespaces=[se],
+                                                   pending=is_future)
+    '''
+    if pending is not None and namespaces is None:
+        raise ValueError('Pending children are resolved while encoding, '
+                         'namespaces must be passed explicitly')
+    for chunk in _iter_chunks(struct, indent, chunk_size, namespaces,
+                              encoding, pending=pending):
+        if type(chunk) is _Pending:
+            chunk.value = yield chunk.child
+            continue
+        result = write(chunk)
+        if result is not None:
+            yield result
+
+
+_compressed_formats = {'gzip': 16 + zlib.MAX_WBITS,
+                       'zlib': zlib.MAX_WBITS,
+                       'raw': -zlib.MAX_WBITS}
+
+
+class CompressedWriter(object):
+    '''
+    File-like sink that compresses what is written to it and passes
+    compressed data to `write`, so `encode_to` streams a compressed
+    document and neither copy of it is kept in memory:
+
+        with CompressedWriter(response.write) as out:
+            encode_to(out, plant)
+
+    `format` is 'gzip', 'zlib' (HTTP deflate) or 'raw' deflate, any other
+    codec can be passed as `compressor`, an object with `compress(data)` and
+    `flush(mode)` methods like `zlib.compressobj()`. Input is compressed by
+    blocks of `block_size` bytes. After every `flush_size` bytes of input
+    (e.g. for HTTP chunks) and on `flush()` compressor is flushed, so the
+    receiver can decompress everything written so far. `raw_bytes` and
+    `compressed_bytes` count input and output.
+    '''
+
+    def __init__(self, write, format='gzip', level=6, block_size=65536,
+                 flush_size=None, compressor=None):
+        if compressor is None:
+            if format not in _compressed_formats:
+                raise ValueError('Unknown compressed format %r' % format)
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                          _compressed_formats[format])
+        self.compressor = compressor
+        self._write = write
+        self.block_size = block_size
+        self.flush_size = flush_size
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self._block = []
+        self._block_bytes = 0
+        # input bytes since the last flush
+        self._unflushed = 0
+
+    def _output(self, data):
+        if data:
+            self.compressed_bytes += len(data)
+            self._write(data)
+
+    def _compress(self):
+        if self._block:
+            block = self._block[0] if len(self._block) == 1 \
+                    else ''.join(self._block)
+            self._block = []
+            self._block_bytes = 0
+            self._output(self.compressor.compress(block))
+
+    def write(self, data):
+        self.raw_bytes += len(data)
+        self._block.append(data)
+        self._block_bytes += len(data)
+        self._unflushed += len(data)
+        if self._block_bytes >= self.block_size:
+            self._compress()
+        if self.flush_size is not None and \
+                self._unflushed >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        '''Writes compressed data of everything written so far'''
+        self._compress()
+        self._unflushed = 0
+        self._output(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def close(self):
+        '''Writes the rest of compressed data and the end of stream'''
+        if self.compressor is not None:
+            self._compress()
+            self._output(self.compressor.flush(zlib.Z_FINISH))
+            self.compressor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def _encode_attr_value(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return _quote_attr(str(value))
+
+
+def _update_namespace(namespaces, uri, prefix, declare=True):
+    if prefix in namespaces:
+        if uri != namespaces[prefix]:
+            raise ValueError('Namespace prefix %r represents '
+                             'different namespaces: %r, %r' % (
+                             prefix,
+                             namespaces[prefix],
+                             uri))
+    elif declare:
+        namespaces[prefix] = uri
+    else:
+        raise ValueError('Namespace %r is not declared' % uri)
+
+
+def _enter(records, name, attrs):
+    '''
+    Calls handlers of tag `name` of visitor `records`, returns records of
+    visitors that descend into the tag
+    '''
+    key = (name.prefix, name.clark) if type(name) is qname else name
+    descend = []
+    for record in records:
+        try:
+            handler = record[1][key]
+        except KeyError:
+            handler = record[1][key] = record[0].handler(name)
+        if handler(name, attrs) is not _skip:
+            descend.append(record)
+    return descend
+
+
+def _visit(struct, visitors):
+    '''Walks `struct` once calling all `visitors`'''
+    # record of visitor is (visitor, cache of handlers by tag, content
+    # handler); qnames are keyed by prefix and Clark name, so neither equal
+    # prefixed strings nor other prefixes of the namespace share handlers
+    records = [(v, {}, v.visit_content) for v in visitors]
+    if isinstance(struct, PlantBuffer):
+        # visitors of open elements
+        stack = [records]
+        for event in struct._events():
+            if type(event) is tuple:
+                name, attrs, empty = event
+                active = _enter(stack[-1], name, attrs) if stack[-1] else ()
+                if not empty:
+                    stack.append(active)
+            elif event is _end:
+                stack.pop()
+            else:
+                for record in stack[-1]:
+                    record[2](event)
+        return
+    # explicit stack of (children iterator, records of visitors)
+    stack = [(iter((struct,)), records)]
+    while stack:
+        children, active = stack[-1]
+        for child in children:
+            if isinstance(child, (list, tuple)):
+                if len(child) > 1 and isinstance(child[1], dict):
+                    attrs, grandchildren = child[1], child[2:]
+                else:
+                    attrs, grandchildren = {}, child[1:]
+                # `_enter` inlined, it is called for every tag
+                name = child[0]
+                key = (name.prefix, name.clark) if type(name) is qname \
+                      else name
+                descend = []
+                for record in active:
+                    try:
+                        handler = record[1][key]
+                    except KeyError:
+                        handler = record[1][key] = record[0].handler(name)
+                    if handler(name, attrs) is not _skip:
+                        descend.append(record)
+                if descend:
+                    stack.append((iter(grandchildren), descend))
+                    break
+                continue
+            if type(child) not in _plain_children and _is_lazy(child):
+                for record in active:
+                    child = record[0].visit_lazy(child)
+                # walked in a frame of its own, the rest of `children`
+                # continues when it is exhausted
+                stack.append((iter(child), active))
+                break
+            for record in active:
+                record[2](child)
+        else:
+            stack.pop()
+
+
+_skip = object()
+_identifier = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')
 
 
 class Visitor(object):
+    '''
+    Walks a plant (or `PlantBuffer`) calling a handler for every tag and
+    `visit_content` for text. Handler of a tag is a method named in
+    `tag_handlers` (tag -> method name), or `visit_<name>` method (local
+    name for qnames), or `visit_tag`. Handlers are called with tag name and
+    attributes dict, which must not be modified; returning `SKIP` prunes
+    the subtree. Several visitors walk a plant at once with `visit_all`.
+    '''
+
+    SKIP = _skip
+    tag_handlers = {}
 
     def visit(self, struct):
         self.general_visit(struct)
         return self
 
     def general_visit(self, struct):
-        name, attrs, children = _unpack(struct)
-        self.visit_tag(name, dict(attrs))
-        for child in children:
-            if isinstance(child, (list, tuple)):
-                self.general_visit(child)
-            else:
-                self.visit_content(child)
+        _visit(struct, [self])
+
+    def handler(self, name):
+        '''Returns handler of tag `name`, called once per tag name'''
+        method = self.tag_handlers.get(name)
+        if method is not None:
+            return getattr(self, method)
+        local = name.name if isinstance(name, qname) else name
+        if local not in ('tag', 'content', 'lazy') and \
+                _identifier.match(local):
+            return getattr(self, 'visit_' + local, self.visit_tag)
+        return self.visit_tag
 
     def visit_tag(self, name, attrs):
         pass
@@ -292,6 +2535,22 @@ class Visitor(object):
     def visit_content(self, content):
         pass
 
+    def visit_lazy(self, children):
+        '''
+        Called with lazy children (generator or iterator) before they are
+        consumed, returns iterable of children to visit instead.
+        '''
+        return children
+
+
+def visit_all(struct, *visitors):
+    '''
+    Walks `struct` once for all `visitors`, a subtree is skipped only by
+    visitors that returned `Visitor.SKIP` for it. Returns `visitors`.
+    '''
+    _visit(struct, visitors)
+    return visitors
+
 
 class NamespaceCollector(Visitor):
 
@@ -299,20 +2558,34 @@ class NamespaceCollector(Visitor):
         self.namespaces = {}
 
     def update_namespace(self, uri, prefix):
-        if prefix in self.namespaces and uri != self.namespaces[prefix]:
-            raise ValueError('Namespace prefix %r represents '
-                             'different namespaces: %r, %r' % (
-                             prefix,
-                             self.namespaces[prefix],
-                             uri))
-        self.namespaces[prefix] = uri
+        _update_namespace(self.namespaces, uri, prefix)
+
+    def handler(self, name):
+        # namespace of a tag name is collected once per prefix and uri,
+        # when its handler is resolved, only attributes are checked for
+        # every tag
+        if isinstance(name, qname):
+            self.update_namespace(name.uri, 'xmlns:'+name.prefix)
+        return self.visit_attrs
 
     def visit_tag(self, name, attrs):
-        for n in [name]+attrs.keys():
+        self.handler(name)
+        self.visit_attrs(name, attrs)
+
+    def visit_attrs(self, name, attrs):
+        for n in attrs:
             if isinstance(n, qname):
                 self.update_namespace(n.uri, 'xmlns:'+n.prefix)
 
 
+class _SinglePassCollector(NamespaceCollector):
+    '''Namespace collector for a walk that precedes encoding'''
+
+    def visit_lazy(self, children):
+        raise ValueError('Lazy children can be consumed only once, '
+                         'namespaces must be passed explicitly')
+
+
 def update_tag(tag, name=None, attrs=None, children=()):
     old_name, old_attrs, old_children = _unpack(tag)
     if name is None:
@@ -326,19 +2599,418 @@ def update_tag(tag, name=None, attrs=None, children=()):
     return tuple([name, attrs]+list(children))
 
 
+def _clone_etree(tree, impl):
+    '''
+    Copies tree node by node. `copy.deepcopy` of `xml.etree` elements is
+    implemented in python and is much slower.
+    '''
+    root = impl.Element(tree.tag, tree.attrib)
+    root.text = tree.text
+    stack = [(tree, root)]
+    while stack:
+        node, new_node = stack.pop()
+        for child in node:
+            new_child = impl.SubElement(new_node, child.tag, child.attrib)
+            new_child.text, new_child.tail = child.text, child.tail
+            if len(child):
+                stack.append((child, new_child))
+    return root
+
+
+class slot(object):
+    '''
+    Placeholder for a value in a `Template`. Can be used as a child (text or
+    plant) or as an attribute value.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<slot %r>' % self.name
+
+
+def _mark_slots(struct, text_marker, attr_marker, slots, level=0, indent=0):
+    '''
+    Returns copy of `struct` with slots replaced by markers. Every slot found
+    is appended to `slots` as `(kind, name, level, is_last)` and the marker
+    contains its index in `slots`.
+    '''
+    name, attrs, children = _unpack(struct)
+    for k, v in attrs.items():
+        if isinstance(v, slot):
+            attrs[k] = attr_marker % len(slots)
+            slots.append(('attr', v.name, level, False))
+    marked = [name, attrs]
+    child_level = level+1 if indent else 0
+    for i, child in enumerate(children):
+        if isinstance(child, slot):
+            marked.append(text_marker % len(slots))
+            slots.append(('text', child.name, level, i == len(children)-1))
+        elif is_eplant_node(child):
+            marked.append(_mark_slots(child, text_marker, attr_marker, slots,
+                                      child_level, indent))
+        else:
+            marked.append(child)
+    return tuple(marked)
+
+
+class Template(object):
+    '''
+    Plant with `slot` placeholders, compiled once. Static parts are encoded
+    in advance and etree skeleton is built once, so rendering only deals with
+    values of slots:
+
+        >>> page = Template(('html', ('body', {'class': slot('cls')},
+        ...                           slot('content'))))
+        >>> page.encode(cls='main', content=('p', 'hello'))
+        '<?xml version="1.0"?>\\n<html><body class="main"><p>hello</p></body></html>'
+
+    Slot value can be text or a plant, attribute slot value is converted as
+    any attribute value. Namespaces of plants given as slot values must be
+    declared upfront with `namespaces` (list of `namespace` objects), unless
+    they are used in static part of template.
+    '''
+
+    _encode_text_marker = '\x00t%d\x00'
+    _encode_attr_marker = '\x00a%d\x00'
+    _encode_markers = re.compile('\x00t(\\d+)\x00|"\x00a(\\d+)\x00"')
+    _etree_text_marker = u'\ue000%d\ue001'
+    _etree_attr_marker = u'\ue002%d\ue001'
+    _etree_markers = re.compile(u'\ue000(\\d+)\ue001')
+    _etree_attr_markers = re.compile(u'^\ue002(\\d+)\ue001$')
+
+    def __init__(self, struct, indent=0, namespaces=None, impl=ElementTree,
+                 converters=None):
+        if not is_eplant_node(struct):
+            raise ValueError('Not an eplant structure')
+        self.struct = struct
+        self.indent = indent
+        self.planter = _planter_class(impl)(impl, converters)
+        self._compile_encode(namespaces or [])
+        self._skeleton = None
+
+    def _compile_encode(self, namespaces):
+        slots = []
+        struct = _mark_slots(self.struct, self._encode_text_marker,
+                             self._encode_attr_marker, slots,
+                             indent=self.indent)
+        self.namespaces = NamespaceCollector().visit(struct).namespaces
+        for ns in namespaces:
+            _update_namespace(self.namespaces, ns.uri, 'xmlns:'+ns.prefix)
+        source = encode(update_tag(struct, attrs=self.namespaces),
+                        indent=self.indent)
+        # static parts at even positions, slots at odd ones
+        parts = self._encode_markers.split(source)
+        self._parts = [parts[0]]
+        for i in xrange(1, len(parts), 3):
+            kind, name, level, is_last = slots[int(parts[i] or parts[i+1])]
+            suffix = ''
+            if self.indent:
+                # the same as indentation after the last child tag
+                suffix = '\n'*is_last + ' '*self.indent*level
+            child_level = level+1 if self.indent else 0
+            self._parts.append((kind, name, child_level, suffix))
+            self._parts.append(parts[i+2])
+
+    def _value(self, values, name):
+        try:
+            return values[name]
+        except KeyError:
+            raise ValueError('No value for slot %r' % name)
+
+    def encode(self, **values):
+        '''Returns the same as `encode` of the plant with slots filled'''
+        parts = self._parts
+        out = [parts[0]]
+        write = out.append
+        for i in xrange(1, len(parts), 2):
+            kind, name, level, suffix = parts[i]
+            value = self._value(values, name)
+            if kind == 'attr':
+                write(_encode_attr_value(value))
+            elif isinstance(value, str):
+                write(_escape_cdata(value))
+            elif isinstance(value, unicode):
+                write(_escape_cdata(value.encode('utf-8')))
+            else:
+                out.extend(_iter_encode_tag(value, indent=self.indent,
+                                            level=level,
+                                            namespaces=self.namespaces,
+                                            declare=False))
+                write(suffix)
+            write(parts[i+1])
+        return str(''.join(out))
+
+    def _compile_etree(self):
+        slots = []
+        struct = _mark_slots(self.struct, self._etree_text_marker,
+                             self._etree_attr_marker, slots)
+        self._skeleton = self.planter.to_etree(struct)
+        # (kind, path to node, data) in document order
+        targets = []
+        def add_text_target(kind, path, text):
+            if text and self._etree_markers.search(text):
+                segments = self._etree_markers.split(text)
+                for i in xrange(1, len(segments), 2):
+                    segments[i] = slots[int(segments[i])][1]
+                targets.append((kind, path, segments))
+        stack = [(self._skeleton, ())]
+        while stack:
+            node, path = stack.pop()
+            for k, v in node.attrib.items():
+                match = self._etree_attr_markers.match(v)
+                if match:
+                    name = slots[int(match.group(1))][1]
+                    targets.append(('attr', path, (k, name)))
+            add_text_target('text', path, node.text)
+            if path:
+                add_text_target('tail', path, node.tail)
+            for i in reversed(xrange(len(node))):
+                stack.append((node[i], path+(i,)))
+        # targets are filled in reverse order, so elements inserted into
+        # a node do not shift positions of targets not filled yet
+        targets.reverse()
+        self._targets = targets
+
+    def _render_segments(self, segments, values, node):
+        '''Returns text and list of elements (with tails) for segments'''
+        text = None
+        elements = []
+        content = segments[0] or None
+        for i in xrange(1, len(segments), 2):
+            value = self._value(values, segments[i])
+            if is_eplant_node(value):
+                if content:
+                    if elements:
+                        elements[-1].tail = content
+                    else:
+                        text = content
+                    content = None
+                elements.append(self.planter.to_etree(value))
+            elif isinstance(value, fragment):
+                value, new_elements = value.to_etree(self.planter.impl)
+                if value:
+                    content = value if content is None else content + value
+                if new_elements:
+                    if content:
+                        if elements:
+                            elements[-1].tail = content
+                        else:
+                            text = content
+                    elements.extend(new_elements)
+                    content, elements[-1].tail = elements[-1].tail, None
+            else:
+                value = self.planter.convert_text(value, node)
+                content = value if content is None else content + value
+            if segments[i+1]:
+                content = segments[i+1] if content is None \
+                                         else content + segments[i+1]
+        if content is not None and elements:
+            elements[-1].tail = content
+        elif content is not None:
+            text = content
+        return text, elements
+
+    def to_etree(self, **values):
+        '''Returns the same as `to_etree` of the plant with slots filled'''
+        if self._skeleton is None:
+            self._compile_etree()
+        impl = self.planter.impl
+        if impl.__name__.startswith('xml.etree.'):
+            tree = _clone_etree(self._skeleton, impl)
+        else:
+            tree = copy.deepcopy(self._skeleton)
+        # qname values are written with prefixes declared on the root
+        return self.planter._rooted(getattr(tree, 'nsmap', None),
+                                    lambda: self._fill_etree(tree, values))
+
+    def _fill_etree(self, tree, values):
+        '''Fills slots of `tree`, copy of the skeleton, with `values`'''
+        # nodes are found before any element is inserted into tree
+        resolved = []
+        for kind, path, data in self._targets:
+            parent = node = tree
+            for i in path:
+                parent, node = node, node[i]
+            resolved.append((node, parent))
+        for (node, parent), (kind, path, data) in zip(resolved,
+                                                      self._targets):
+            if kind == 'attr':
+                k, name = data
+                value = self._value(values, name)
+                converter = self.planter.attr_converter(type(value))
+                if converter is not None:
+                    value = converter(self.planter.impl, value)
+                node.set(k, value)
+                continue
+            text, elements = self._render_segments(data, values, node)
+            if kind == 'text':
+                node.text = text
+                position = 0
+            else:
+                node.tail = text
+                node, position = parent, path[-1] + 1
+            for i, element in enumerate(elements):
+                node.insert(position + i, element)
+        return tree
+
+
+def _compile_path(path, namespaces):
+    '''
+    Returns steps of simple `path` (child names, `*` and `.` separated by
+    `/`) with prefixes resolved, or `None` for other ElementPath syntax.
+    '''
+    from xml.etree.ElementPath import xpath_tokenizer
+    steps = []
+    expect_step = True
+    try:
+        for op, tag in xpath_tokenizer(path, namespaces):
+            if expect_step and tag:
+                steps.append(tag)
+            elif expect_step and op == '*':
+                steps.append(None)
+            elif not (expect_step and op == '.' or
+                      not expect_step and op == '/'):
+                return None
+            expect_step = not expect_step
+    except SyntaxError:
+        return None
+    if expect_step:
+        return None
+    return steps
+
+
+class _CompiledPaths(object):
+    '''
+    Simple paths merged into a tree of steps, so all of them are found in
+    one traversal. Every node is `[target indexes, {tag: node}, * node]`.
+    Paths with other syntax are found with `find` one by one.
+    '''
+
+    def __init__(self, paths, namespaces):
+        self.count = len(paths)
+        self.root = [[], {}, None]
+        self.others = []
+        for i, path in enumerate(paths):
+            steps = _compile_path(path, namespaces)
+            if steps is None:
+                self.others.append((i, path))
+                continue
+            node = self.root
+            for step in steps:
+                if step is None:
+                    if node[2] is None:
+                        node[2] = [[], {}, None]
+                    node = node[2]
+                else:
+                    node = node[1].setdefault(step, [[], {}, None])
+            node[0].append(i)
+
+    def find(self, tree, namespaces):
+        '''
+        Returns list of first matches of paths in `tree` (element or element
+        tree), `None` for paths that return empty set.
+        '''
+        found = [None] * self.count
+        for i, path in self.others:
+            # cElementTree does not accept keyword arguments
+            found[i] = tree.find(path, namespaces)
+        element = tree.getroot() if hasattr(tree, 'getroot') else tree
+        for i in self.root[0]:
+            found[i] = element
+        left = self.count - len(self.others) - len(self.root[0])
+        # elements are visited in document order, like ElementPath does
+        stack = [(iter(element), [self.root])]
+        while stack and left:
+            children, nodes = stack[-1]
+            if len(nodes) == 1 and nodes[0][2] is None:
+                # the most common case, one step without wildcard
+                tags = nodes[0][1]
+                for child in children:
+                    tag = child.tag
+                    if type(tag) is not str:
+                        # `impl.QName` hashes and compares in python
+                        tag = getattr(tag, 'text', tag)
+                    if tag in tags:
+                        node = tags[tag]
+                        for i in node[0]:
+                            if found[i] is None:
+                                found[i] = child
+                                left -= 1
+                        if node[1] or node[2]:
+                            stack.append((iter(child), [node]))
+                            break
+                else:
+                    stack.pop()
+                continue
+            for child in children:
+                tag = child.tag
+                if type(tag) is not str:
+                    tag = getattr(tag, 'text', tag)
+                matched = []
+                for node in nodes:
+                    tag_node = node[1].get(tag)
+                    if tag_node is not None:
+                        matched.append(tag_node)
+                    if node[2] is not None:
+                        matched.append(node[2])
+                if not matched:
+                    continue
+                for node in matched:
+                    for i in node[0]:
+                        if found[i] is None:
+                            found[i] = child
+                            left -= 1
+                matched = [node for node in matched if node[1] or node[2]]
+                if matched:
+                    stack.append((iter(child), matched))
+                    break
+            else:
+                stack.pop()
+        return found
+
+
+_compiled_paths = {}
+
+
+def _compiled(paths, namespaces, namespaces_key):
+    key = paths, namespaces_key
+    try:
+        return _compiled_paths[key]
+    except KeyError:
+        if len(_compiled_paths) >= 1024:
+            _compiled_paths.clear()
+        value = _compiled_paths[key] = _CompiledPaths(paths, namespaces)
+        return value
+
+
 class EtreeModifier(object):
+    '''
+    Finds and modifies elements of `tree` by ElementPath. Paths are compiled
+    once per process, `apply` and `extract` find all of their paths in a
+    single traversal of the tree.
+    '''
 
     def __init__(self, tree, namespaces=None):
         self.tree = tree
         self.namespaces = namespaces or {}
+        self._namespaces_key = tuple(sorted(self.namespaces.items()))
+
+    def _find_all(self, paths, namespaces=None):
+        ns, key = self.namespaces, self._namespaces_key
+        if namespaces:
+            ns = dict(ns)
+            ns.update(namespaces)
+            key = tuple(sorted(ns.items()))
+        found = _compiled(paths, ns, key).find(self.tree, ns)
+        for path, node in zip(paths, found):
+            if node is None:
+                raise ValueError('Path %r returns empty set' % path)
+        return found
 
     def find_or_fail(self, path, namespaces=None):
-        ns = dict(self.namespaces)
-        ns.update(namespaces or {})
-        node = self.tree.find(path, namespaces=ns)
-        if node is None:
-            raise ValueError('Path %r returns empty set' % path)
-        return node
+        return self._find_all((path,), namespaces)[0]
 
     def set_text(self, path, text, namespaces=None):
         self.find_or_fail(path, namespaces).text = text
@@ -352,8 +3024,138 @@ class EtreeModifier(object):
     def get_attr(self, path, name, namespaces=None):
         return self.find_or_fail(path, namespaces).get(name)
 
+    def apply(self, values, namespaces=None):
+        '''
+        Sets many values at once, `values` is a dict with paths as keys for
+        text and `(path, attr name)` pairs as keys for attributes.
+        '''
+        targets = tuple(values)
+        paths = tuple(t if isinstance(t, basestring) else t[0]
+                      for t in targets)
+        for target, node in zip(targets, self._find_all(paths, namespaces)):
+            if isinstance(target, basestring):
+                node.text = values[target]
+            else:
+                node.set(target[1], values[target])
+
+    def extract(self, targets, namespaces=None):
+        '''
+        Returns list of values of `targets`: texts for paths, attributes for
+        `(path, attr name)` pairs.
+        '''
+        targets = tuple(targets)
+        paths = tuple(t if isinstance(t, basestring) else t[0]
+                      for t in targets)
+        return [node.text if isinstance(target, basestring)
+                else node.get(target[1])
+                for target, node in zip(targets,
+                                        self._find_all(paths, namespaces))]
+
     def __getattr__(self, name):
         return getattr(self.tree, name)
 
 
+def _copy_element(element, impl):
+    '''Copies `element` only, children are shared with the original'''
+    new_element = impl.Element(element.tag, element.attrib)
+    new_element.text, new_element.tail = element.text, element.tail
+    new_element.extend(element)
+    return new_element
+
+
+class EtreeTemplate(object):
+    '''
+    Etree built once from plant `struct`. `render` returns a copy of it with
+    values set by paths, the same way as `EtreeModifier.apply` does. Paths
+    are resolved to positions in the skeleton once. With `xml.etree`
+    implementations only elements on the way to the changed ones are
+    copied and the rest is shared with the skeleton, so only changed
+    elements of rendered tree may be modified further.
+    '''
+
+    def __init__(self, struct, namespaces=None, impl=ElementTree,
+                 converters=None):
+        self.planter = _planter_class(impl)(impl, converters)
+        self.skeleton = self.planter.to_etree(struct)
+        self.namespaces = namespaces or {}
+        self._positions = {}
+        self._share = impl.__name__.startswith('xml.etree.')
+
+    def _resolve(self, paths):
+        '''Finds positions (child indexes from root) of `paths`'''
+        found = EtreeModifier(self.skeleton, self.namespaces)._find_all(paths)
+        wanted = {}
+        for path, node in zip(paths, found):
+            wanted.setdefault(id(node), []).append(path)
+        stack = [(self.skeleton, ())]
+        while stack and wanted:
+            node, position = stack.pop()
+            for path in wanted.pop(id(node), ()):
+                self._positions[path] = position
+            for i, child in enumerate(node):
+                stack.append((child, position + (i,)))
+
+    def _copy(self, positions):
+        '''Returns copy of skeleton and copied elements at `positions`'''
+        impl = self.planter.impl
+        if self._share:
+            tree = _copy_element(self.skeleton, impl)
+            copied = {(): tree}
+            for position in positions:
+                node = tree
+                for depth in xrange(1, len(position) + 1):
+                    key = position[:depth]
+                    if key in copied:
+                        node = copied[key]
+                    else:
+                        child = copied[key] = _copy_element(
+                            node[position[depth-1]], impl)
+                        node[position[depth-1]] = node = child
+            return tree, [copied[position] for position in positions]
+        tree = copy.deepcopy(self.skeleton)
+        nodes = []
+        for position in positions:
+            node = tree
+            for i in position:
+                node = node[i]
+            nodes.append(node)
+        return tree, nodes
+
+    def render(self, values=None):
+        '''
+        Returns new tree with `values` set, `values` is a dict with paths as
+        keys for text and `(path, attr name)` pairs as keys for attributes.
+        Values are converted as values of plant.
+        '''
+        values = values or {}
+        targets = tuple(values)
+        paths = tuple(t if isinstance(t, basestring) else t[0]
+                      for t in targets)
+        unknown = tuple(set(p for p in paths if p not in self._positions))
+        if unknown:
+            self._resolve(unknown)
+        tree, nodes = self._copy([self._positions[p] for p in paths])
+        # qname values are written with prefixes declared on the root
+        return self.planter._rooted(
+            getattr(tree, 'nsmap', None),
+            lambda: self._set_values(tree, zip(targets, nodes), values))
+
+    def _set_values(self, tree, targets, values):
+        '''Sets `values` to (target, node) pairs `targets` of `tree`'''
+        planter = self.planter
+        for target, node in targets:
+            value = values[target]
+            if isinstance(target, basestring):
+                node.text = planter.convert_text(value, node)
+                continue
+            name = target[1]
+            if isinstance(name, qname):
+                name = name.clark
+            converter = planter.attr_converter(type(value))
+            if converter is not None:
+                value = converter(planter.impl, value)
+            node.set(name, value)
+        return tree
+
+
 # vim: set sts=4 sw=4 et ai:
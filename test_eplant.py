@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import sys
+import zlib
+import gzip
+import codecs
+import hashlib
 import unittest
 import datetime
 from xml.etree import ElementTree
 from eplant import (
-        _encode_tag, Sample, to_etree, namespace, qname, timestamp,
-        NamespaceCollector, EtreeModifier, encode)
+        _encode_tag, Sample, SampleCache, SampleMemo, Planter, to_etree, namespace, qname, timestamp,
+        NamespaceCollector, Visitor, visit_all, EtreeModifier, EtreeTemplate, encode,
+        encode_iter, encode_to, encode_to_stream, to_xmlfile, PlantBuffer,
+        encode_parallel, slot, Template, safe, fragment, Stats, EncodeCache, Digests, CompressedWriter, set_escape_cache, from_etree,
+        iter_plants, _escape_text, _escape_attr)
+from StringIO import StringIO
+from io import BytesIO
 
 
 has_lxml = False
@@ -165,6 +175,26 @@ class Tests(unittest.TestCase):
                          '  </ns1:tag2>\n'
                          '</ns:tag>')
 
+    def test_encode_xml_with_namespaces_conflict(self):
+        ns = namespace('ns', 'ns')
+        ns1 = namespace('ns1', 'ns')
+        tag = (ns.tag, (ns1.tag2,))
+        with self.assertRaises(ValueError):
+            encode(tag)
+
+    def test_encode_xml_with_declared_namespaces(self):
+        ns = namespace('ns', 'ns')
+        ns1 = namespace('ns1', 'ns1')
+        tag = (ns.tag, {'a': '1'}, (ns1.tag2,))
+        self.assertEqual(encode(tag, namespaces=[ns, ns1]), encode(tag))
+
+    def test_encode_xml_with_undeclared_namespace(self):
+        ns = namespace('ns', 'ns')
+        ns1 = namespace('ns1', 'ns1')
+        tag = (ns.tag, (ns1.tag2,))
+        with self.assertRaises(ValueError):
+            encode(tag, namespaces=[ns])
+
     def test_encode_with_zero_indent(self):
         tag = ('tag', 
             ('tag2', 
@@ -174,8 +204,18 @@ class Tests(unittest.TestCase):
         self.assertEqual(encode(tag), '<?xml version="1.0"?>\n'
                                       '<tag><tag2><tag3/></tag2></tag>')
 
+    def iter_etree(self, tree):
+        # xml.etree iterators are recursive in python 2
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(list(node)))
+
     def assertEqualEtree(self, one, two):
-        for a,b in zip(one.getiterator(), two.getiterator()):
+        self.assertEqual(len(list(self.iter_etree(one))),
+                         len(list(self.iter_etree(two))))
+        for a,b in zip(self.iter_etree(one), self.iter_etree(two)):
             self.assertEqual(a.tag, b.tag)
             self.assertEqual(a.attrib, b.attrib)
             self.assertEqual(a.text, b.text)
@@ -210,6 +250,36 @@ class Tests(unittest.TestCase):
         self.assertEqualEtree(to_etree(('a',), impl=cElementTree),
                               cElementTree.fromstring('<a/>'))
 
+    def deep_plant(self):
+        tag = ('a', 'text')
+        for i in range(sys.getrecursionlimit() * 2):
+            tag = ('a', {'level': i}, 'text', tag, 'tail')
+        return tag
+
+    def test_to_etree_deeper_than_recursion_limit(self):
+        tree = to_etree(self.deep_plant())
+        self.assertEqual(len(list(self.iter_etree(tree))),
+                         sys.getrecursionlimit() * 2 + 1)
+
+    @unittest.skipIf(not has_lxml, 'need lxml')
+    def test_to_etree_same_tree_for_lxml(self):
+        ns = namespace('ns', 'ns')
+        ns1 = namespace('ns1', 'ns1')
+        tag = (ns.tag, {ns1.attr: 1},
+                'text',
+                ('tag1', (ns1.tag2, {'a': True}, 'text'), 'tail'),
+                'tail',
+                self.deep_plant())
+        self.assertEqualEtree(to_etree(tag), to_etree(tag, impl=etree))
+
+    def test_visitor_deeper_than_recursion_limit(self):
+        class Counter(Visitor):
+            tags = 0
+            def visit_tag(self, name, attrs):
+                self.tags += 1
+        self.assertEqual(Counter().visit(self.deep_plant()).tags,
+                         sys.getrecursionlimit() * 2 + 1)
+
     def test_timestamp_from_datetime(self):
         self.assertEqual(timestamp(datetime.datetime(2000, 1, 1)),
                          '2000-01-01T00:00:00')
@@ -224,6 +294,315 @@ class Tests(unittest.TestCase):
                          '2000-01-01T00:00:00+00:00')
 
 
+class VisitorTests(unittest.TestCase):
+
+    ns = namespace('http://x/', 'x')
+
+    class Recorder(Visitor):
+
+        def __init__(self):
+            self.events = []
+
+        def visit_tag(self, name, attrs):
+            self.events.append(name)
+
+        def visit_content(self, content):
+            self.events.append(content)
+
+    def plant(self):
+        ns = self.ns
+        return (ns.Envelope,
+                  (ns.Header, ('From', 'me')),
+                  (ns.Body, {'id': '1'}, ('Item', 'text')),
+                  ('tag', 'content'))
+
+    def test_per_tag_handlers(self):
+        class Handlers(self.Recorder):
+            def visit_Header(self, name, attrs):
+                self.events.append('header')
+            def visit_From(self, name, attrs):
+                self.events.append('from')
+        self.assertEqual(Handlers().visit(self.plant()).events,
+                         [self.ns.Envelope, 'header', 'from', 'me',
+                          self.ns.Body, 'Item', 'text', 'tag', 'content'])
+
+    def test_prefixes_of_one_namespace(self):
+        p, q = namespace('urn:x', 'p'), namespace('urn:x', 'q')
+        plant = ('root', (p.Tag,), (q.Tag,), (p.Tag,))
+        self.assertEqual(NamespaceCollector().visit(plant).namespaces,
+                         {'xmlns:p': 'urn:x', 'xmlns:q': 'urn:x'})
+        result = ''.join(encode_iter(plant))
+        self.assertEqual(result, encode(plant))
+        self.assertEqual([e.tag for e in ElementTree.fromstring(result)],
+                         ['{urn:x}Tag'] * 3)
+
+    def test_tag_handlers_registry(self):
+        other = namespace('http://other/', 'o')
+        class Handlers(self.Recorder):
+            tag_handlers = {other.Body: 'other_body'}
+            def other_body(self, name, attrs):
+                self.events.append('other')
+        plant = ('root', (self.ns.Body,), (other.Body,))
+        self.assertEqual(Handlers().visit(plant).events,
+                         ['root', self.ns.Body, 'other'])
+
+    def test_skip_subtree(self):
+        consumed = []
+        def lazy():
+            consumed.append(True)
+            yield ('Lazy',)
+        class Skipper(self.Recorder):
+            def visit_Body(self, name, attrs):
+                return self.SKIP
+        plant = self.plant() + ((self.ns.Body, lazy()),)
+        self.assertEqual(Skipper().visit(plant).events,
+                         [self.ns.Envelope, self.ns.Header, 'From', 'me',
+                          'tag', 'content'])
+        self.assertEqual(consumed, [])
+
+    def test_attrs_are_not_copied(self):
+        attrs = {'a': '1'}
+        seen = []
+        class Attrs(Visitor):
+            def visit_tag(self, name, attrs):
+                seen.append(attrs)
+        Attrs().visit(('root', attrs))
+        self.assertIs(seen[0], attrs)
+
+    def test_visit_all(self):
+        class Skipper(self.Recorder):
+            def visit_Body(self, name, attrs):
+                return self.SKIP
+        recorder, skipper, collector = visit_all(
+            self.plant(), self.Recorder(), Skipper(), NamespaceCollector())
+        self.assertEqual(recorder.events,
+                         self.Recorder().visit(self.plant()).events)
+        self.assertEqual(skipper.events,
+                         Skipper().visit(self.plant()).events)
+        self.assertEqual(collector.namespaces, {'xmlns:x': 'http://x/'})
+
+    def test_visit_all_plant_buffer(self):
+        buf = PlantBuffer()
+        buf.start('root')
+        buf.start('Body')
+        buf.element('Item', None, 'text')
+        buf.end()
+        buf.element('tag', None, 'content')
+        buf.end()
+        class Skipper(self.Recorder):
+            def visit_Body(self, name, attrs):
+                return self.SKIP
+        recorder, skipper = visit_all(buf, self.Recorder(), Skipper())
+        self.assertEqual(recorder.events,
+                         ['root', 'Body', 'Item', 'text', 'tag', 'content'])
+        self.assertEqual(skipper.events, ['root', 'tag', 'content'])
+
+    def test_namespace_collector_qname_after_string(self):
+        plant = ('root', ('x:Body',), (self.ns.Body,))
+        self.assertEqual(NamespaceCollector().visit(plant).namespaces,
+                         {'xmlns:x': 'http://x/'})
+
+
+class SampleCacheTests(unittest.TestCase):
+
+    def sample_class(self, **kwargs):
+        calls = self.calls = []
+        class Envelope(Sample):
+            _cache = SampleCache(**kwargs)
+            def tag(self):
+                calls.append('tag')
+                return ('tag', self.tag2)
+            def tag2(self):
+                calls.append('tag2')
+                return ('tag2', self.text)
+            def other(self):
+                calls.append('other')
+                return ('other',)
+        return Envelope
+
+    def test_cached_once(self):
+        Envelope = self.sample_class()
+        s = Envelope(text='a')
+        self.assertEqual(s.tag, ('tag', ('tag2', 'a')))
+        self.assertEqual(s.tag, ('tag', ('tag2', 'a')))
+        self.assertEqual(s.tag2, ('tag2', 'a'))
+        self.assertEqual(self.calls, ['tag', 'tag2'])
+        self.assertEqual((Envelope._cache.hits, Envelope._cache.misses),
+                         (2, 2))
+        self.assertNotIn('tag', s.__dict__)
+
+    def test_computed_once_under_contention(self):
+        import threading, time
+        calls = []
+        class Slow(Sample):
+            _cache = SampleCache()
+            def tag(self):
+                calls.append(1)
+                time.sleep(0.05)
+                return ('tag',)
+        s = Slow()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(s.tag))
+                   for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [('tag',)] * 5)
+
+    def test_assignment_invalidates_dependents(self):
+        s = self.sample_class()(text='a')
+        s.tag, s.other
+        s.text = 'b'
+        self.assertEqual(s.tag, ('tag', ('tag2', 'b')))
+        s.tag2 = ('override',)
+        self.assertEqual(s.tag, ('tag', ('override',)))
+        del s.tag2
+        self.assertEqual(s.tag, ('tag', ('tag2', 'b')))
+        self.assertEqual(self.calls,
+                         ['tag', 'tag2', 'other', 'tag', 'tag2', 'tag',
+                          'tag', 'tag2'])
+
+    def test_private_inputs(self):
+        calls = []
+        class Envelope(Sample):
+            _cache = SampleCache()
+            _suffix = 'a'
+            def tag(self):
+                return ('tag', self.tag2)
+            def tag2(self):
+                calls.append('tag2')
+                return 'v' + self._suffix
+        s = Envelope()
+        self.assertEqual((s.tag2, s.tag), ('va', ('tag', 'va')))
+        s._suffix = 'b'
+        self.assertEqual((s.tag2, s.tag), ('vb', ('tag', 'vb')))
+        self.assertEqual(calls, ['tag2', 'tag2'])
+
+    def test_invalidate(self):
+        Envelope = self.sample_class()
+        s = Envelope(text='a')
+        s.tag, s.other
+        Envelope._cache.invalidate(s, 'tag2')
+        s.tag, s.other
+        Envelope._cache.invalidate(s)
+        s.other
+        self.assertEqual(self.calls,
+                         ['tag', 'tag2', 'other', 'tag', 'tag2', 'other'])
+
+    def test_size(self):
+        s = self.sample_class(size=1)(text='a')
+        s.tag2, s.other, s.other, s.tag2
+        self.assertEqual(self.calls, ['tag2', 'other', 'tag2'])
+
+    def test_ttl(self):
+        now = [0]
+        Envelope = self.sample_class(ttl=10, clock=lambda: now[0])
+        s = Envelope(text='a')
+        s.tag2
+        now[0] = 5
+        s.tag
+        now[0] = 10
+        # expired tag2 invalidates tag computed from it
+        s.tag2, s.tag
+        now[0] = 15
+        s.tag2, s.tag
+        self.assertEqual(self.calls, ['tag2', 'tag', 'tag2', 'tag'])
+
+
+class SampleMemoTests(unittest.TestCase):
+
+    def sample_class(self, memo=None, cache=None):
+        calls = self.calls = []
+        class Envelope(Sample):
+            _memo = memo or SampleMemo()
+            _cache = cache
+            def envelope(self):
+                calls.append('envelope')
+                return ('envelope', self.header, self.body)
+            def header(self):
+                calls.append('header')
+                return ('header', ('user', self.user))
+            def body(self):
+                calls.append('body')
+                return ('body', getattr(self, 'text', 'default'))
+        return Envelope
+
+    def test_reused_across_instances(self):
+        Envelope = self.sample_class()
+        self.assertEqual(Envelope(user='a').envelope,
+                         ('envelope', ('header', ('user', 'a')),
+                                      ('body', 'default')))
+        self.assertEqual(Envelope(user='a').envelope,
+                         ('envelope', ('header', ('user', 'a')),
+                                      ('body', 'default')))
+        self.assertEqual(self.calls, ['envelope', 'header', 'body'])
+        self.assertEqual((Envelope._memo.hits, Envelope._memo.misses), (1, 3))
+
+    def test_only_dependent_parts_are_recomputed(self):
+        Envelope = self.sample_class()
+        Envelope(user='a').envelope
+        self.assertEqual(Envelope(user='b').envelope,
+                         ('envelope', ('header', ('user', 'b')),
+                                      ('body', 'default')))
+        self.assertEqual(Envelope(user='b', text='c').body, ('body', 'c'))
+        self.assertEqual(self.calls, ['envelope', 'header', 'body',
+                                      'envelope', 'header', 'body'])
+
+    def test_overridden_parts(self):
+        Envelope = self.sample_class()
+        Envelope(user='a').envelope
+        self.assertEqual(Envelope(user='a', header=('h',)).envelope,
+                         ('envelope', ('h',), ('body', 'default')))
+        self.assertEqual(self.calls, ['envelope', 'header', 'body',
+                                      'envelope'])
+
+    def test_unhashable_inputs(self):
+        Envelope = self.sample_class()
+        Envelope(user=['a']).header
+        self.assertEqual(Envelope(user=['b']).header,
+                         ('header', ('user', ['b'])))
+        self.assertEqual(self.calls, ['header', 'header'])
+
+    def test_attributes_are_stored(self):
+        Envelope = self.sample_class(memo=SampleMemo(size=1))
+        s = Envelope(user=['a'])
+        self.assertIs(s.header, s.header)
+        s = Envelope(user='a')
+        self.assertIs(s.envelope, s.envelope)
+        Envelope(user='b').header
+        # evicted, but kept by the instance
+        self.assertIs(s.envelope, s.envelope)
+        self.assertEqual(self.calls, ['header', 'envelope', 'header', 'body',
+                                      'header'])
+
+    def test_size(self):
+        Envelope = self.sample_class(memo=SampleMemo(size=1))
+        Envelope(user='a').header, Envelope(user='b').header
+        Envelope(user='a').header, Envelope(user='a').header
+        self.assertEqual(self.calls, ['header'] * 3)
+
+    def test_subclasses_are_not_mixed(self):
+        Envelope = self.sample_class()
+        class Other(Envelope):
+            def body(self):
+                return ('other',)
+        Envelope(user='a').envelope
+        self.assertEqual(Other(user='a').envelope,
+                         ('envelope', ('header', ('user', 'a')), ('other',)))
+
+    def test_with_cache(self):
+        Envelope = self.sample_class(cache=SampleCache())
+        s = Envelope(user='a')
+        s.header, s.envelope, s.envelope
+        Envelope(user='a').envelope
+        self.assertEqual(self.calls, ['header', 'envelope', 'body'])
+        s.user = 'b'
+        self.assertEqual(s.envelope, ('envelope', ('header', ('user', 'b')),
+                                                  ('body', 'default')))
+
+
 class TypeConversionTests(unittest.TestCase):
 
     def assertEtreeStrEquals(self, struct, value):
@@ -265,6 +644,1278 @@ class TypeConversionTests(unittest.TestCase):
                                         '<a xmlns:ns0="urn:n">ns0:tag</a>')
 
 
+class EscapingTests(unittest.TestCase):
+
+    values = ['', 'text', 'true', '<&>', '"quoted"', "'quoted'", '"\'both',
+              'a\nb\rc\td', '<a href="x">&amp;</a>' * 10]
+
+    def tearDown(self):
+        set_escape_cache()
+
+    def assertSameAsSaxutils(self):
+        from xml.sax.saxutils import escape, quoteattr
+        for value in self.values * 2:
+            self.assertEqual(_escape_text(value), escape(value))
+            self.assertIsInstance(_escape_text(value), safe)
+            self.assertEqual(_escape_attr(value), quoteattr(value))
+            self.assertIsInstance(_escape_attr(value), safe)
+
+    def test_same_as_saxutils(self):
+        self.assertSameAsSaxutils()
+
+    def test_same_as_saxutils_without_cache(self):
+        set_escape_cache(0, 0)
+        self.assertSameAsSaxutils()
+
+    def test_same_as_saxutils_with_small_cache(self):
+        set_escape_cache(2, 2)
+        self.assertSameAsSaxutils()
+
+    def test_safe_is_not_escaped(self):
+        self.assertEqual(_escape_text(safe('<tag/>')), '<tag/>')
+        self.assertEqual(_escape_attr(safe('"&amp;"')), '"&amp;"')
+
+    def test_cache_is_bounded(self):
+        from eplant import _attr_cache
+        set_escape_cache(0, 10)
+        for i in range(100):
+            _escape_attr(str(i))
+        self.assertTrue(0 < len(_attr_cache) <= 10)
+
+
+class PlanterTests(unittest.TestCase):
+
+    def test_reuse(self):
+        planter = Planter()
+        for i in range(3):
+            self.assertEqual(ElementTree.tostring(planter.to_etree(
+                                 ('a', {'b': i}, True))),
+                             '<a b="%d">true</a>' % i)
+
+    def test_custom_converter(self):
+        class Money(float):
+            pass
+        planter = Planter(converters={Money: lambda i,v: u'%.2f' % v})
+        self.assertEqual(ElementTree.tostring(planter.to_etree(
+                             ('a', {'b': Money(1)}, Money(2), 1.5))),
+                         '<a b="1.00">2.001.5</a>')
+
+    def test_attr_converted_once(self):
+        calls = []
+        class MyStr(str):
+            pass
+        def convert(impl, value):
+            calls.append(value)
+            return value.decode('utf-8')
+        planter = Planter(converters={MyStr: convert})
+        planter.to_etree(('a', {'b': MyStr('value')}))
+        self.assertEqual(calls, ['value'])
+
+    def test_converter_is_cached_per_type(self):
+        planter = Planter()
+        planter.to_etree(('a', {'b': 1}, 'text', None))
+        self.assertEqual(set(planter._attr_converters), set([int]))
+        self.assertEqual(set(planter._text_converters),
+                         set([str, type(None)]))
+
+    @unittest.skipIf(not has_lxml, 'need lxml')
+    def test_lxml_impl(self):
+        ns = namespace('urn:n', 'ns0')
+        planter = Planter(etree)
+        self.assertEqual(etree.tostring(planter.to_etree(('a', ns.tag))),
+                         '<a xmlns:ns0="urn:n">ns0:tag</a>')
+
+
+@unittest.skipUnless(has_lxml, 'lxml is not installed')
+class LxmlPlanterTests(unittest.TestCase):
+
+    x = namespace('http://x/', 'x')
+    y = namespace('http://y/', 'y')
+
+    def plant(self):
+        x, y = self.x, self.y
+        return (x.root, {'a': 1, x.b: True, 'c': y.value, 'n': None},
+                  'text',
+                  (y.child, u'текст', ('empty',), 'tail'),
+                  x.content,
+                  (x.child, {'f': 2.5}),
+                  'end')
+
+    def write(self, plant, **kwargs):
+        out = BytesIO()
+        with etree.xmlfile(out, encoding='utf-8') as xf:
+            to_xmlfile(xf, plant, **kwargs)
+        return out.getvalue()
+
+    def test_namespaces_declared_on_root(self):
+        tree = to_etree(self.plant(), impl=etree)
+        self.assertEqual(tree.nsmap, {'x': 'http://x/', 'y': 'http://y/'})
+        self.assertEqual(etree.tostring(tree),
+                         '<x:root xmlns:x="http://x/" xmlns:y="http://y/" '
+                         'a="1" c="y:value" n="" x:b="true">text'
+                         '<y:child>&#1090;&#1077;&#1082;&#1089;&#1090;'
+                         '<empty/>tail</y:child>x:content'
+                         '<x:child f="2.5"/>end</x:root>')
+
+    def test_same_tree_as_generic_planter(self):
+        plant = ('root', {self.x.a: '1'},
+                   (self.x.tag, 'text', (self.y.tag, {'b': 'c'})), 'tail')
+        one, two = to_etree(plant, impl=etree), Planter(etree).to_etree(plant)
+        self.assertEqual(
+            [(e.tag, e.attrib, e.text, e.tail) for e in one.iter()],
+            [(e.tag, e.attrib, e.text, e.tail) for e in two.iter()])
+
+    def test_explicit_namespaces(self):
+        z = namespace('http://z/', 'z')
+        tree = to_etree(self.plant(), impl=etree,
+                        namespaces=[self.x, self.y, z])
+        self.assertEqual(tree.nsmap, {'x': 'http://x/', 'y': 'http://y/',
+                                      'z': 'http://z/'})
+        # namespaces that are not given are declared where they are used
+        tree = to_etree((self.x.root, (self.y.child,)), impl=etree,
+                        namespaces=[self.x])
+        self.assertEqual(tree.nsmap, {'x': 'http://x/'})
+        self.assertEqual(tree[0].tag, '{http://y/}child')
+
+    def test_prefix_conflict(self):
+        other = namespace('http://other/', 'x')
+        tree = to_etree((self.x.root, (other.child,)), impl=etree)
+        self.assertEqual(tree.nsmap, {'x': 'http://x/'})
+        self.assertEqual(tree[0].tag, '{http://other/}child')
+
+    def test_qname_values(self):
+        other = namespace('http://other/', 'x')
+        # prefix of a value wins over prefix of a name
+        tree = to_etree((self.x.root, {'a': other.value}, other.content),
+                        impl=etree)
+        self.assertEqual(tree.nsmap['x'], 'http://other/')
+        self.assertEqual((tree.tag, tree.get('a'), tree.text),
+                         ('{http://x/}root', 'x:value', 'x:content'))
+        # prefix is bound to other namespace on the root element
+        self.assertRaises(ValueError, to_etree,
+                          ('root', self.x.value, other.value), impl=etree)
+        self.assertRaises(ValueError, self.write,
+                          ('root', self.x.value, iter([other.value])))
+        # prefix is not declared on the root element
+        plant = lambda: ('root', (('item', self.y.value) for i in [0]))
+        self.assertRaises(ValueError, to_etree, plant(), impl=etree)
+        self.assertRaises(ValueError, self.write, plant())
+        tree = to_etree(plant(), impl=etree, namespaces=[self.y])
+        self.assertEqual(tree[0].text, 'y:value')
+        self.assertEqual(self.write(plant(), namespaces=[self.y]),
+                         '<root xmlns:y="http://y/"><item>y:value</item>'
+                         '</root>')
+
+    def test_to_xmlfile(self):
+        self.assertEqual(
+            etree.tostring(etree.fromstring(self.write(self.plant()))),
+            etree.tostring(to_etree(self.plant(), impl=etree)))
+
+    def test_to_xmlfile_lazy_children(self):
+        plant = (self.x.root,
+                   (('item', str(i)) for i in range(3)),
+                   (self.x.last, (self.y.tag,)))
+        self.assertEqual(self.write(plant),
+                         '<x:root xmlns:x="http://x/" xmlns:y="http://y/">'
+                         '<item>0</item><item>1</item><item>2</item>'
+                         '<x:last><y:tag></y:tag></x:last></x:root>')
+
+    def test_to_xmlfile_fragment(self):
+        plant = ('root', 'a', fragment.from_plant(('f', 'text')), 'b')
+        self.assertEqual(self.write(plant),
+                         '<root>a<f>text</f>b</root>')
+
+    def test_stats(self):
+        stats = Stats()
+        to_etree(self.plant(), impl=etree, stats=stats)
+        self.assertEqual((stats.nodes, stats.attributes), (4, 5))
+        self.assertEqual(stats.converters['qname'], 2)
+
+
+class TemplateTests(unittest.TestCase):
+
+    se = namespace('http://schemas.xmlsoap.org/soap/envelope/', 'se')
+    mhe = namespace('http://my.header.ext/', 'mhe')
+
+    def envelope(self, who, body):
+        se, mhe = self.se, self.mhe
+        return (se.Envelope,
+                    (se.Header,
+                        (mhe.From, {se.mustUnderstand: True}, who)),
+                    (se.Body, body),
+                    'tail')
+
+    def assertEqualEtree(self, one, two):
+        self.assertEqual(ElementTree.tostring(one), ElementTree.tostring(two))
+
+    def test_encode(self):
+        for indent in (0, 2):
+            template = Template(self.envelope(slot('who'), slot('body')),
+                                indent=indent)
+            for body in ['hello', u'привет <>', ('tag', {'a': 1}, 'text')]:
+                self.assertEqual(template.encode(who='me', body=body),
+                                 encode(self.envelope('me', body),
+                                        indent=indent))
+
+    def test_encode_attr(self):
+        template = Template(('tag', {'a': slot('a'), 'b': 'static'}))
+        self.assertEqual(template.encode(a='"quoted"'),
+                         encode(('tag', {'a': '"quoted"', 'b': 'static'})))
+
+    def test_encode_declared_namespaces(self):
+        ns = namespace('ns', 'ns')
+        template = Template(('tag', slot('body')), namespaces=[ns])
+        self.assertEqual(template.encode(body=(ns.tag2,)),
+                         '<?xml version="1.0"?>\n'
+                         '<tag xmlns:ns="ns"><ns:tag2/></tag>')
+
+    def test_encode_undeclared_namespace(self):
+        ns = namespace('ns', 'ns')
+        template = Template(('tag', slot('body')))
+        with self.assertRaises(ValueError):
+            template.encode(body=(ns.tag2,))
+
+    def test_missing_value(self):
+        template = Template(('tag', slot('body')))
+        with self.assertRaises(ValueError):
+            template.encode()
+        with self.assertRaises(ValueError):
+            template.to_etree()
+
+    def test_to_etree(self):
+        template = Template(self.envelope(slot('who'), slot('body')))
+        for body in ['hello', 1, ('tag', {'a': 1}, 'text')]:
+            self.assertEqualEtree(template.to_etree(who='me', body=body),
+                                  to_etree(self.envelope('me', body)))
+
+    def test_to_etree_mixed_content(self):
+        plant = ('a', 'text', slot('x'), ('b',), slot('y'), 'tail',
+                 ('c', {'attr': slot('z')}))
+        template = Template(plant)
+        values = dict(x=('x', 'x'), y='y', z=1)
+        self.assertEqualEtree(template.to_etree(**values),
+                              to_etree(('a', 'text', ('x', 'x'), ('b',), 'y',
+                                        'tail', ('c', {'attr': 1}))))
+
+    def test_to_etree_does_not_change_skeleton(self):
+        template = Template(('a', slot('x')))
+        template.to_etree(x=('b',))
+        self.assertEqualEtree(template.to_etree(x='text'),
+                              to_etree(('a', 'text')))
+
+    @unittest.skipIf(not has_lxml, 'need lxml')
+    def test_to_etree_lxml(self):
+        template = Template(self.envelope(slot('who'), slot('body')),
+                            impl=etree)
+        self.assertEqual(
+            etree.tostring(template.to_etree(who='me', body=('tag', 'text'))),
+            etree.tostring(to_etree(self.envelope('me', ('tag', 'text')),
+                                    impl=etree)))
+
+    @unittest.skipIf(not has_lxml, 'need lxml')
+    def test_to_etree_lxml_qname_values(self):
+        se = self.se
+        template = Template((se.Fault, {'code': slot('code')},
+                               'at ', slot('at')), impl=etree)
+        tree = template.to_etree(code=se.Server, at=se.Body)
+        self.assertEqual((tree.get('code'), tree.text),
+                         ('se:Server', 'at se:Body'))
+        self.assertRaises(ValueError, template.to_etree,
+                          code=self.mhe.Server, at='')
+
+
+class EncodingTests(unittest.TestCase):
+
+    def sample(self):
+        ns = namespace('ns', 'ns')
+        return (ns.tag, {'attr': u'значение & "quotes"'},
+                 ('tag1', u'текст <>'),
+                 'utf-8 str \xd1\x82',
+                 (ns.tag2, {ns.attr: 1}))
+
+    def assertParsesSame(self, xml, indent=0):
+        one = ElementTree.fromstring(encode(self.sample(), indent=indent))
+        two = ElementTree.fromstring(xml)
+        self.assertEqual(ElementTree.tostring(one), ElementTree.tostring(two))
+
+    def test_default_encoding(self):
+        self.assertEqual(encode(self.sample(), encoding='utf-8'),
+                         encode(self.sample()).replace(
+                             '<?xml version="1.0"?>',
+                             '<?xml version="1.0" encoding="utf-8"?>'))
+
+    def test_ascii(self):
+        xml = encode(self.sample(), encoding='ascii')
+        xml.decode('ascii')
+        self.assertIn('&#1090;&#1077;&#1082;&#1089;&#1090;', xml)
+        self.assertParsesSame(xml)
+
+    def test_latin1(self):
+        xml = encode(('a', {'b': u'caf\xe9'}, u'\xe9\u20ac'), encoding='latin-1')
+        self.assertEqual(xml, '<?xml version="1.0" encoding="latin-1"?>\n'
+                              '<a b="caf\xe9">\xe9&#8364;</a>')
+
+    def test_utf16(self):
+        xml = encode(self.sample(), indent=2, encoding='utf-16')
+        self.assertTrue(xml.startswith(codecs.BOM_UTF16))
+        self.assertEqual(xml.count(codecs.BOM_UTF16), 1)
+        self.assertEqual(xml.decode('utf-16'),
+                         encode(self.sample(), indent=2, encoding='utf-8')
+                            .decode('utf-8').replace('"utf-8"', '"utf-16"'))
+        self.assertParsesSame(xml, indent=2)
+
+    def test_utf16_streaming(self):
+        ns = namespace('ns', 'ns')
+        self.assertEqual(''.join(encode_iter(self.sample(), chunk_size=10,
+                                             encoding='utf-16')),
+                         encode(self.sample(), encoding='utf-16'))
+        self.assertEqual(''.join(encode_iter(self.sample(), chunk_size=10,
+                                             encoding='utf-16',
+                                             namespaces=[ns])),
+                         encode(self.sample(), encoding='utf-16'))
+
+
+class ParallelEncodeTests(unittest.TestCase):
+
+    def sample(self):
+        ns = namespace('ns', 'ns')
+        return (ns.tag, {'attr': 'value'},
+                'text',
+                (ns.tag1, u'текст'),
+                ('tag2', {ns.attr: 1}, ('tag3',)),
+                ('tag4',),
+                'tail')
+
+    def test_same_as_encode(self):
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(2)
+        for indent in (0, 2):
+            for chunk_size in (1, 2, 10):
+                self.assertEqual(encode_parallel(self.sample(), indent=indent,
+                                                 chunk_size=chunk_size,
+                                                 pool=pool),
+                                 encode(self.sample(), indent=indent))
+
+    def test_process_pool(self):
+        self.assertEqual(encode_parallel(self.sample(), workers=2,
+                                         chunk_size=2),
+                         encode(self.sample()))
+
+    def test_threads(self):
+        import threading
+        results = {}
+        def run(n):
+            plant = ('root',) + tuple(('item', str(n), str(i))
+                                      for i in range(200))
+            results[n] = [encode_parallel(plant, workers=2, chunk_size=50)
+                          == encode(plant) for i in range(5)]
+        threads = [threading.Thread(target=run, args=(n,)) for n in (1, 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {1: [True]*5, 2: [True]*5})
+
+    def test_encoding(self):
+        self.assertEqual(encode_parallel(self.sample(), workers=2,
+                                         chunk_size=2, encoding='utf-16'),
+                         encode(self.sample(), encoding='utf-16'))
+
+    def test_declared_namespaces(self):
+        from multiprocessing.pool import ThreadPool
+        ns = namespace('ns', 'ns')
+        self.assertEqual(encode_parallel(self.sample(), namespaces=[ns],
+                                         pool=ThreadPool(2)),
+                         encode(self.sample(), namespaces=[ns]))
+        with self.assertRaises(ValueError):
+            encode_parallel(self.sample(), namespaces=[], pool=ThreadPool(2))
+
+    def test_empty_root(self):
+        self.assertEqual(encode_parallel(('tag',), workers=1),
+                         encode(('tag',)))
+
+
+class StreamingEncodeTests(unittest.TestCase):
+
+    def sample(self):
+        ns = namespace('ns', 'ns')
+        return (ns.tag,
+                 ('tag1',),
+                 'text',
+                 (ns.tag2, {'attr': '<value>'},
+                     (ns.tag3, u'текст'),
+                     (ns.tag4,)))
+
+    def test_encode_iter_equals_encode(self):
+        for indent in (0, 2, 4):
+            self.assertEqual(''.join(encode_iter(self.sample(), indent=indent)),
+                             encode(self.sample(), indent=indent))
+
+    def test_encode_iter_chunks(self):
+        chunks = list(encode_iter(self.sample(), indent=2, chunk_size=16))
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks:
+            self.assertIsInstance(chunk, str)
+        self.assertEqual(''.join(chunks), encode(self.sample(), indent=2))
+
+    def test_encode_iter_with_declared_namespaces(self):
+        ns = namespace('ns', 'ns')
+        self.assertEqual(''.join(encode_iter(self.sample(), indent=2,
+                                             namespaces=[ns])),
+                         encode(self.sample(), indent=2))
+
+    def test_encode_to(self):
+        fp = StringIO()
+        encode_to(fp, self.sample(), indent=2, chunk_size=16)
+        self.assertEqual(fp.getvalue(), encode(self.sample(), indent=2))
+
+    def test_encode_tag_deeper_than_recursion_limit(self):
+        tag = ('tag',)
+        for i in range(sys.getrecursionlimit() * 2):
+            tag = ('tag', tag)
+        self.assertTrue(_encode_tag(tag, indent=0).startswith('<tag><tag>'))
+
+
+class Future(object):
+
+    def __init__(self, result):
+        self.result = result
+
+
+class EncodeToStreamTests(unittest.TestCase):
+    '''`encode_to_stream` driven the way event loops drive coroutines'''
+
+    ns = namespace('ns', 'ns')
+
+    def run_loop(self, coroutine):
+        '''Returns list of yielded objects, futures are resolved'''
+        yielded = []
+        try:
+            item = next(coroutine)
+            while True:
+                yielded.append(item)
+                item = coroutine.send(item.result
+                                      if isinstance(item, Future) else None)
+        except StopIteration:
+            return yielded
+
+    def test_backpressure(self):
+        events = []
+        def write(chunk):
+            events.append(chunk)
+            return 'flushed'
+        plant = ('root',) + tuple(('item', str(i)) for i in range(10))
+        yielded = self.run_loop(encode_to_stream(write, plant,
+                                                 chunk_size=16))
+        self.assertTrue(len(events) > 1)
+        self.assertEqual(yielded, ['flushed'] * len(events))
+        self.assertEqual(''.join(events), encode(plant))
+
+    def pending_plant(self):
+        ns = self.ns
+        return (ns.root, 'a',
+                  Future((ns.x, 'y')),
+                  Future(iter([('i', '1'), Future('t'), ('i', '2')])),
+                  Future(iter([])),
+                  ('z',),
+                  Future('end'))
+
+    def test_pending_children(self):
+        ns = self.ns
+        expected = (ns.root, 'a', (ns.x, 'y'), ('i', '1'), 't', ('i', '2'),
+                    ('z',), 'end')
+        for indent in (0, 2):
+            out = []
+            yielded = self.run_loop(encode_to_stream(
+                out.append, self.pending_plant(), indent=indent,
+                namespaces=[ns], pending=lambda c: isinstance(c, Future)))
+            self.assertEqual(len(yielded), 5)
+            self.assertEqual(''.join(out), encode(expected, indent=indent))
+
+    def test_chunks_written_before_waiting(self):
+        out = []
+        future = Future(('b',))
+        coroutine = encode_to_stream(out.append, ('root', ('a',), future),
+                                     namespaces=[],
+                                     pending=lambda c: isinstance(c, Future))
+        self.assertIs(next(coroutine), future)
+        self.assertEqual(''.join(out), '<?xml version="1.0"?>\n<root><a/>')
+        self.assertRaises(StopIteration, coroutine.send, future.result)
+        self.assertEqual(''.join(out),
+                         '<?xml version="1.0"?>\n<root><a/><b/></root>')
+
+    def test_namespaces_required(self):
+        with self.assertRaisesRegexp(ValueError, 'namespaces'):
+            next(encode_to_stream(lambda chunk: None, ('root',),
+                                  pending=lambda c: False))
+
+
+class QNameTests(unittest.TestCase):
+
+    def test_qnames_are_interned(self):
+        ns = namespace('http://x/', 'x')
+        self.assertIs(ns.tag, ns.tag)
+        self.assertIs(ns('tag'), ns.tag)
+        self.assertIs(ns / 'tag', ns.tag)
+        self.assertIs(ns(qname('tag', 'http://y/', 'y'), force=True), ns.tag)
+        self.assertIsNot(namespace('http://x/', 'x').tag, ns.tag)
+
+    def test_clark_notation(self):
+        name = namespace('http://x/', 'x').tag
+        self.assertEqual(name.clark, '{http://x/}tag')
+        self.assertEqual(name.to_etree(), name.clark)
+        self.assertFalse(hasattr(name, '__dict__'))
+
+    def test_pickle(self):
+        import pickle
+        name = namespace('http://x/', 'x').tag
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(name, protocol))
+            self.assertEqual(copy, name)
+            self.assertEqual((copy.name, copy.uri, copy.prefix, copy.clark),
+                             (name.name, name.uri, name.prefix, name.clark))
+
+    def test_etree_qname_cache(self):
+        ns = namespace('http://x/', 'x')
+        tree = to_etree(('root', (ns.tag,), (ns.tag,)))
+        self.assertIs(tree[0].tag, tree[1].tag)
+        self.assertEqual(tree[0].tag.text, '{http://x/}tag')
+
+
+class EtreeModifierTests(unittest.TestCase):
+
+    ns = namespace('http://x/', 'x')
+
+    def modifier(self, impl=ElementTree):
+        ns = self.ns
+        tree = to_etree((ns.root,
+                           (ns.header, ('from', 'a'), ('to', {'id': '1'}, 'b')),
+                           (ns.body,
+                             ('item', '1'),
+                             ('item', {'id': '2'}, '2'),
+                             ('other', ('item', '3')))),
+                        impl=impl)
+        return EtreeModifier(tree, {'x': ns.uri})
+
+    def test_set_and_get(self):
+        modifier = self.modifier()
+        modifier.set_text('x:header/from', 'c')
+        self.assertEqual(modifier.get_text('x:header/from'), 'c')
+        modifier.set_attr('x:body/item', 'id', '0')
+        self.assertEqual(modifier.get_attr('x:body/item', 'id'), '0')
+        self.assertEqual(modifier.get_text('./{http://x/}body/*/item'), '3')
+        self.assertEqual(modifier.get_text('x:body/item[2]'), '2')
+        self.assertEqual(modifier.get_text('.//item', {'x': 'other'}), '1')
+        self.assertRaises(ValueError, modifier.get_text, 'x:body/none')
+
+    def test_apply(self):
+        modifier = self.modifier()
+        modifier.apply({'x:header/from': 'c',
+                        'x:header/to': 'd',
+                        ('x:header/to', 'id'): '2',
+                        'x:body/other/item': '4',
+                        ('.', 'attr'): 'value'})
+        self.assertEqual(modifier.extract(['x:header/from', 'x:header/to',
+                                           ('x:header/to', 'id'),
+                                           'x:body/*/item', ('.', 'attr'),
+                                           'x:body/item[last()]']),
+                         ['c', 'd', '2', '4', 'value', '2'])
+        self.assertRaises(ValueError, modifier.apply,
+                          {'x:header/from': 'c', 'x:header/none': 'd'})
+
+    def test_element_tree(self):
+        modifier = self.modifier()
+        modifier = EtreeModifier(ElementTree.ElementTree(modifier.tree),
+                                 modifier.namespaces)
+        self.assertEqual(modifier.extract(['x:header/from', 'x:body/item']),
+                         ['a', '1'])
+
+    @unittest.skipUnless(has_lxml, 'lxml is not installed')
+    def test_lxml(self):
+        modifier = self.modifier(etree)
+        modifier.apply({'x:header/from': 'c', ('x:body/item', 'id'): '0'})
+        self.assertEqual(modifier.extract(['x:header/from',
+                                           ('x:body/item', 'id')]),
+                         ['c', '0'])
+
+
+class EtreeTemplateTests(unittest.TestCase):
+
+    ns = namespace('http://x/', 'x')
+
+    def plant(self, attr='a', sender='a', id='1', item='2'):
+        ns = self.ns
+        return (ns.root, {ns.attr: attr},
+                  (ns.header, ('from', sender), ('to', 'b')),
+                  (ns.body,
+                    ('item', {'id': id}, '1'),
+                    ('item', item)))
+
+    def render(self, impl, values):
+        template = EtreeTemplate(self.plant(), {'x': self.ns.uri}, impl=impl)
+        skeleton = impl.tostring(template.skeleton)
+        for i in range(2):
+            tree = template.render(values)
+            self.assertEqual(impl.tostring(template.skeleton), skeleton)
+        return tree
+
+    def check(self, impl=ElementTree):
+        tree = self.render(impl, {'x:header/from': 'c',
+                                  ('x:body/item', 'id'): 5,
+                                  'x:body/item[2]': u'текст',
+                                  ('.', self.ns.attr): True})
+        expected = to_etree(self.plant(attr=True, sender='c', id=5,
+                                       item=u'текст'),
+                            impl=impl)
+        self.assertEqual(impl.tostring(tree), impl.tostring(expected))
+
+    def test_render(self):
+        self.check()
+
+    @unittest.skipUnless(has_lxml, 'lxml is not installed')
+    def test_render_lxml(self):
+        self.check(etree)
+
+    @unittest.skipUnless(has_lxml, 'lxml is not installed')
+    def test_render_lxml_qname_values(self):
+        tree = self.render(etree, {'x:header/from': self.ns.sender,
+                                   ('x:body/item', 'id'): self.ns.id})
+        self.assertEqual(tree[0][0].text, 'x:sender')
+        self.assertEqual(tree[1][0].get('id'), 'x:id')
+        template = EtreeTemplate(self.plant(), {'x': self.ns.uri}, impl=etree)
+        self.assertRaises(ValueError, template.render,
+                          {'x:header/from': namespace('http://y/', 'y').a})
+
+    def test_unchanged_subtrees_are_shared(self):
+        template = EtreeTemplate(self.plant(), {'x': self.ns.uri})
+        tree = template.render({'x:header/from': 'c'})
+        self.assertIsNot(tree, template.skeleton)
+        self.assertIsNot(tree[0], template.skeleton[0])
+        self.assertIsNot(tree[0][0], template.skeleton[0][0])
+        self.assertIs(tree[0][1], template.skeleton[0][1])
+        self.assertIs(tree[1], template.skeleton[1])
+
+    def test_unknown_path(self):
+        template = EtreeTemplate(self.plant())
+        self.assertRaises(ValueError, template.render, {'none': 'c'})
+
+
+class FragmentTests(unittest.TestCase):
+
+    ns = namespace('http://x/', 'x')
+
+    def sub(self):
+        return (self.ns.sub, {'attr': u'значение'}, 'text', ('child', '<&>'))
+
+    def test_encode(self):
+        f = fragment.from_plant(self.sub())
+        self.assertEqual(f, u'<x:sub attr="значение" xmlns:x="http://x/">'
+                            u'text<child>&lt;&amp;&gt;</child></x:sub>'
+                            .encode('utf-8'))
+        self.assertEqual(encode(('root', 'a', f, 'b', f)),
+                         '<?xml version="1.0"?>\n<root>a%sb%s</root>' % (f, f))
+
+    def test_encode_iter_writes_large_fragment_as_is(self):
+        f = fragment('<a>%s</a>' % ('x' * 100))
+        chunks = list(encode_iter(('root', 'text', f), chunk_size=50))
+        self.assertTrue(any(chunk is f for chunk in chunks))
+        self.assertEqual(''.join(chunks), encode(('root', 'text', f)))
+
+    def check_to_etree(self, impl):
+        f = fragment('lead<a x="1">in<b/></a>mid<c/>tail')
+        tree = to_etree(('root', 'pre', f, 'post', f, ('d',)), impl=impl)
+        expected = to_etree(('root', 'prelead',
+                               ('a', {'x': '1'}, 'in', ('b',)), 'mid',
+                               ('c',), 'tailpostlead',
+                               ('a', {'x': '1'}, 'in', ('b',)), 'mid',
+                               ('c',), 'tail',
+                               ('d',)),
+                            impl=impl)
+        self.assertEqual(impl.tostring(tree), impl.tostring(expected))
+        # parsed once, copies are inserted
+        self.assertEqual(list(f._parsed), [impl])
+        self.assertIsNot(tree[0], tree[2])
+        # descendants are copied too, changes do not leak to the next tree
+        tree[0][0].set('y', '2')
+        tree[0][0].text = tree[0][0].tail = 'changed'
+        self.assertEqual(impl.tostring(to_etree(('root', f), impl=impl)),
+                         '<root>lead<a x="1">in<b%s/></a>mid<c%s/>tail'
+                         '</root>' % ((' ', ' ') if impl is ElementTree
+                                      else ('', '')))
+
+    def test_to_etree(self):
+        self.check_to_etree(ElementTree)
+
+    @unittest.skipUnless(has_lxml, 'lxml is not installed')
+    def test_to_etree_lxml(self):
+        self.check_to_etree(etree)
+
+    def test_namespaces(self):
+        f = fragment.from_plant(self.sub())
+        tree = to_etree(('root', f))
+        self.assertEqual(tree[0].tag, '{http://x/}sub')
+
+    def test_template(self):
+        f = fragment('<a/>tail')
+        template = Template(('root', 'pre', slot('value')))
+        self.assertEqual(template.encode(value=f),
+                         encode(('root', 'pre', f)))
+        self.assertEqual(ElementTree.tostring(template.to_etree(value=f)),
+                         '<root>pre<a />tail</root>')
+
+
+class StatsTests(unittest.TestCase):
+
+    ns = namespace('http://x/', 'x')
+
+    def plant(self):
+        return ('root', {'a': 1, 'b': 'value'},
+                  'te<t',
+                  (self.ns.child, {self.ns.attr: 2.5}, u'текст'),
+                  ('empty',))
+
+    def test_encode(self):
+        stats = Stats()
+        result = encode(self.plant(), namespaces=[self.ns], stats=stats)
+        self.assertEqual(result, encode(self.plant(), namespaces=[self.ns]))
+        self.assertEqual((stats.nodes, stats.attributes), (3, 4))
+        self.assertEqual(stats.converters, {'int': 1, 'str': 2, 'float': 1})
+        self.assertEqual(stats.escaped_bytes, 
+                         len('te&lt;t') + len(u'текст'.encode('utf-8')) +
+                         len('1value2.5') + len(self.ns.uri))
+        self.assertEqual(stats.output_bytes, len(result))
+        self.assertEqual(sorted(stats.timings), ['encode', 'join'])
+
+    def test_collected_namespaces(self):
+        stats = Stats()
+        encode(self.plant(), stats=stats)
+        encode(self.plant(), stats=stats)
+        self.assertEqual((stats.nodes, stats.attributes), (6, 6))
+        self.assertEqual(stats.output_bytes, len(encode(self.plant())) * 2)
+
+    def test_encode_iter(self):
+        stats = Stats()
+        chunks = list(encode_iter(self.plant(), chunk_size=8, stats=stats))
+        self.assertEqual(''.join(chunks), encode(self.plant()))
+        self.assertEqual(stats.nodes, 3)
+        self.assertEqual(stats.output_bytes, len(''.join(chunks)))
+        self.assertEqual(sorted(stats.timings), ['namespaces'])
+
+    def test_to_etree(self):
+        stats = Stats()
+        tree = to_etree(self.plant(), stats=stats)
+        self.assertEqual(ElementTree.tostring(tree),
+                         ElementTree.tostring(to_etree(self.plant())))
+        self.assertEqual((stats.nodes, stats.attributes), (3, 3))
+        self.assertEqual(stats.converters,
+                         {'int': 1, 'str': 2, 'float': 1, 'unicode': 1})
+        self.assertEqual(sorted(stats.timings), ['to_etree'])
+
+    def test_as_dict(self):
+        stats = Stats()
+        to_etree(self.plant(), stats=stats)
+        values = stats.as_dict()
+        self.assertEqual(values['nodes'], 3)
+        self.assertEqual(values['converters.unicode'], 1)
+        self.assertIn('timings.to_etree', values)
+
+
+class EncodeCacheTests(unittest.TestCase):
+
+    ns = namespace('http://x/', 'x')
+
+    def address(self):
+        return (self.ns.address,
+                  (self.ns.street, 'Baker Street & 221b'),
+                  ('city', u'Лондон'))
+
+    def plant(self, address):
+        return ('orders',) + tuple(
+            ('order', {'id': str(i)}, ('total', str(i)), address)
+            for i in range(3))
+
+    def check(self, plant, cache, **kwargs):
+        self.assertEqual(encode(plant, cache=cache, **kwargs),
+                         encode(plant, **kwargs))
+
+    def test_shared(self):
+        cache = EncodeCache(min_bytes=0)
+        plant = self.plant(self.address())
+        for indent in [0, 2]:
+            self.check(plant, cache, indent=indent)
+            self.check(plant, cache, indent=indent, encoding='cp1251',
+                       namespaces=[self.ns])
+        # kept when seen the second time, once per encoding and indent
+        self.assertEqual((cache.hits, cache.misses), (4, 8))
+        self.assertEqual(len(cache._entries), 4)
+
+    def test_equal(self):
+        cache = EncodeCache(min_bytes=0)
+        self.check(self.plant(self.address()), cache, indent=2)
+        self.check(('other', ('order', self.address())), cache, indent=2)
+        self.assertEqual(cache.hits, 2)
+
+    def test_namespaces(self):
+        cache = EncodeCache(min_bytes=0)
+        other = namespace('http://other/', 'x')
+        self.check(self.plant(self.address()), cache)
+        # equal, but prefix is of other namespace or not a qname at all
+        self.assertRaises(ValueError, encode, ('root', (other.address,),
+                          self.plant(self.address())), cache=cache)
+        self.check(self.plant(('x:address', ('x:street', 'a'), ('b',))),
+                   cache)
+        self.check(self.plant((other.address, ('x:street', 'a'), ('b',))),
+                   cache)
+
+    def test_not_cached(self):
+        cache = EncodeCache(min_bytes=0)
+        plant = ('root',
+                   ('a', {'k': 'v'}, ('b', 'text')),
+                   ('a', ('b',), ['c']),
+                   ('a', ('b',), (c for c in [('lazy',)])))
+        self.assertEqual(
+            encode(plant, cache=cache),
+            '<?xml version="1.0"?>\n<root><a k="v"><b>text</b></a>'
+            '<a><b/><c/></a><a><b/><lazy/></a></root>')
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache._entries, {})
+
+    def test_deep(self):
+        def deep():
+            tag = ('leaf', 'text')
+            for i in range(sys.getrecursionlimit() * 20):
+                tag = ('node', tag)
+            return tag
+        cache = EncodeCache(max_nesting=3)
+        plant = deep()
+        # only subtrees nested in less than `max_nesting` missed ones are
+        # looked up, the first one is kept when it is seen the second time
+        self.check(plant, cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+        self.check(plant, cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 6))
+        self.check(plant, cache)
+        # equal plant is compared without recursion
+        self.check(deep(), cache)
+        self.assertEqual((cache.hits, cache.misses), (2, 6))
+
+    def test_eviction(self):
+        cache = EncodeCache(size=2, min_bytes=12)
+        s0, s1, s2 = [('a', ('b', str(i) * 10)) for i in range(3)]
+        small = ('a', ('b',))
+        self.check(('root', s0, s1, s0, s1, s2, s0), cache)
+        self.assertEqual(cache.hits, 1)
+        self.check(('root', s2, small, small, small), cache)
+        self.assertEqual(cache.hits, 1)
+        # least recently used s1 is dropped, small one is not kept
+        self.assertEqual([key[0] for key, output, names
+                          in cache._entries.values()], [s0, s2])
+        self.assertEqual(cache.bytes, len('<a><b>0000000000</b></a>') * 2)
+        cache = EncodeCache(max_bytes=30, min_bytes=0)
+        self.check(('root', s0, s1, s0, s1), cache)
+        self.assertEqual(len(cache._entries), 1)
+        cache.clear()
+        self.assertEqual((cache.bytes, len(cache._entries)), (0, 0))
+
+
+class CanonicalTests(unittest.TestCase):
+
+    se = namespace('http://schemas.xmlsoap.org/soap/envelope/', 'se')
+    wsu = namespace('http://wsu/', 'wsu')
+    m = namespace('http://m/', 'm')
+
+    def plant(self):
+        self.timestamp = (self.wsu.Timestamp, {self.wsu.Id: 'ts'},
+                            (self.wsu.Created, 'now'))
+        self.item = (self.m.Item, {'z': 'a\t"b"', 'a': 1}, 'x\r\n<y>')
+        self.body = (self.se.Body, {self.wsu.Id: 'body'}, self.item, ('empty',))
+        return (self.se.Envelope, (self.se.Header, self.timestamp), self.body)
+
+    def test_canonical(self):
+        self.assertEqual(
+            encode(self.plant(), canonical=True),
+            '<se:Envelope xmlns:se="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<se:Header><wsu:Timestamp xmlns:wsu="http://wsu/" wsu:Id="ts">'
+            '<wsu:Created>now</wsu:Created></wsu:Timestamp></se:Header>'
+            '<se:Body xmlns:wsu="http://wsu/" wsu:Id="body">'
+            '<m:Item xmlns:m="http://m/" a="1" z="a&#x9;&quot;b&quot;">'
+            'x&#xD;\n&lt;y&gt;</m:Item><empty></empty></se:Body>'
+            '</se:Envelope>')
+
+    def test_safe_attribute_value(self):
+        # quoted and escaped as by `encode`
+        self.assertEqual(encode(('a', {'x': safe('v&"')}), canonical=True),
+                         '<a x="v&amp;&quot;"></a>')
+
+    def test_digests(self):
+        plant = self.plant()
+        digests = Digests([self.body, self.item, self.timestamp])
+        result = encode(plant, digests=digests)
+        self.assertEqual(result, encode(plant, canonical=True))
+        body = ('<se:Body xmlns:se="http://schemas.xmlsoap.org/soap/envelope/"'
+                ' xmlns:wsu="http://wsu/" wsu:Id="body">'
+                '<m:Item xmlns:m="http://m/" a="1" z="a&#x9;&quot;b&quot;">'
+                'x&#xD;\n&lt;y&gt;</m:Item><empty></empty></se:Body>')
+        self.assertEqual(digests[self.body], hashlib.sha1(body).digest())
+        digests = Digests([self.body], 'sha256')
+        chunks = list(encode_iter(plant, chunk_size=16, digests=digests))
+        self.assertEqual(''.join(chunks), result)
+        self.assertEqual(digests[self.body], hashlib.sha256(body).digest())
+        self.assertRaises(KeyError, digests.__getitem__, self.item)
+
+    @unittest.skipUnless(has_lxml, 'lxml is not installed')
+    def test_lxml_c14n(self):
+        plant = self.plant()
+        digests = Digests([self.body, self.item, self.timestamp])
+        root = etree.fromstring(encode(plant, digests=digests))
+        self.assertEqual(etree.tostring(root, method='c14n', exclusive=True),
+                         encode(plant, canonical=True))
+        for subtree, element in [(self.timestamp, root[0][0]),
+                                 (self.body, root[1]),
+                                 (self.item, root[1][0])]:
+            c14n = etree.tostring(element, method='c14n', exclusive=True)
+            self.assertEqual(digests[subtree], hashlib.sha1(c14n).digest())
+
+    def test_errors(self):
+        self.assertRaises(ValueError, encode, self.plant(), indent=2,
+                          canonical=True)
+        self.assertRaises(ValueError, encode, self.plant(),
+                          encoding='cp1251', canonical=True)
+        self.assertRaises(ValueError, encode, self.plant(),
+                          namespaces=[self.se], canonical=True)
+        self.assertRaises(ValueError, Digests, [], 'nosuchhash')
+
+
+class CompressedWriterTests(unittest.TestCase):
+
+    def plant(self):
+        return ('rows',) + tuple(('row', {'id': str(i)}, 'name %d' % i)
+                                 for i in range(1000))
+
+    def test_formats(self):
+        for format, wbits in [('gzip', 16 + zlib.MAX_WBITS),
+                              ('zlib', zlib.MAX_WBITS),
+                              ('raw', -zlib.MAX_WBITS)]:
+            chunks = []
+            with CompressedWriter(chunks.append, format) as out:
+                encode_to(out, self.plant(), chunk_size=1024)
+            self.assertEqual(zlib.decompress(''.join(chunks), wbits),
+                             encode(self.plant()))
+            self.assertEqual(out.raw_bytes, len(encode(self.plant())))
+            self.assertEqual(out.compressed_bytes, len(''.join(chunks)))
+            if format == 'gzip':
+                self.assertEqual(
+                    gzip.GzipFile(fileobj=BytesIO(''.join(chunks))).read(),
+                    encode(self.plant()))
+        self.assertRaises(ValueError, CompressedWriter, chunks.append, 'lzw')
+
+    def test_blocks(self):
+        class Compressor(object):
+            def __init__(self):
+                self.blocks = []
+            def compress(self, data):
+                self.blocks.append(len(data))
+                return data
+            def flush(self, mode):
+                return ''
+        chunks = []
+        compressor = Compressor()
+        out = CompressedWriter(chunks.append, block_size=1000,
+                               compressor=compressor)
+        encode_to(out, self.plant(), chunk_size=300)
+        out.close()
+        self.assertEqual(''.join(chunks), encode(self.plant()))
+        self.assertTrue(all(size >= 1000 for size in compressor.blocks[:-1]))
+
+    def test_flush(self):
+        chunks = []
+        out = CompressedWriter(chunks.append, 'zlib', flush_size=5000)
+        encode_to(out, self.plant(), chunk_size=1024)
+        # what is written is decompressed without the end of stream
+        data = zlib.decompressobj().decompress(''.join(chunks))
+        self.assertTrue(encode(self.plant()).startswith(data))
+        self.assertTrue(len(data) > out.raw_bytes - 5000)
+        out.flush()
+        data = zlib.decompressobj().decompress(''.join(chunks))
+        self.assertEqual(data, encode(self.plant()))
+        out.close()
+        out.close()
+        self.assertEqual(zlib.decompress(''.join(chunks)), data)
+
+
+class PlantBufferTests(unittest.TestCase):
+
+    ns = namespace('http://x/', 'x')
+
+    def plant(self):
+        ns = self.ns
+        return (ns.root, {'a': '1'},
+                  'text',
+                  (ns.row, {ns.id: '1', 'b': '<'},
+                      ('name', u'имя'),
+                      ('empty',)),
+                  'tail',
+                  (ns.row,),
+                  'end')
+
+    def buffer(self):
+        ns = self.ns
+        buf = PlantBuffer()
+        buf.start(ns.root, {'a': '1'})
+        buf.text('text')
+        buf.start(ns.row, {ns.id: '1', 'b': '<'})
+        buf.element('name', None, u'имя')
+        buf.element('empty')
+        buf.end()
+        buf.text('tail')
+        buf.element(ns.row)
+        buf.text('end')
+        buf.end()
+        return buf
+
+    def test_encode(self):
+        for indent in (0, 2):
+            self.assertEqual(encode(self.buffer(), indent=indent),
+                             encode(self.plant(), indent=indent))
+        self.assertEqual(''.join(encode_iter(self.buffer(), chunk_size=8)),
+                         encode(self.plant()))
+
+    def test_namespaces(self):
+        self.assertEqual(encode(self.buffer(), namespaces=[self.ns]),
+                         encode(self.plant()))
+        with self.assertRaisesRegexp(ValueError, 'not declared'):
+            encode(self.buffer(), namespaces=[])
+        buf = PlantBuffer()
+        buf.start(self.ns.root)
+        buf.element(namespace('http://y/', 'x').row)
+        buf.end()
+        with self.assertRaisesRegexp(ValueError, 'different namespaces'):
+            encode(buf)
+
+    def test_qname_and_string_names(self):
+        buf = PlantBuffer()
+        buf.start(self.ns.root)
+        buf.element('x:root')
+        buf.end()
+        self.assertEqual(encode(buf), encode((self.ns.root, ('x:root',))))
+
+    def test_prefixes_of_one_namespace(self):
+        other = namespace(self.ns.uri, 'y')
+        plant = (self.ns.root, (other.root, {other.id: '1', self.ns.id: '2'}))
+        buf = PlantBuffer()
+        buf.start(self.ns.root)
+        buf.element(other.root, {other.id: '1', self.ns.id: '2'})
+        buf.end()
+        self.assertEqual(encode(buf), encode(plant))
+        self.assertEqual(ElementTree.tostring(to_etree(buf)),
+                         ElementTree.tostring(to_etree(plant)))
+
+    def test_to_etree(self):
+        self.assertEqual(ElementTree.tostring(to_etree(self.buffer())),
+                         ElementTree.tostring(to_etree(self.plant())))
+
+    @unittest.skipUnless(has_lxml, 'lxml is not installed')
+    def test_to_etree_lxml(self):
+        self.assertEqual(etree.tostring(to_etree(self.buffer(), impl=etree)),
+                         etree.tostring(to_etree(self.plant(), impl=etree)))
+
+    def test_visitor(self):
+        class Recorder(Visitor):
+            def __init__(self):
+                self.events = []
+            def visit_tag(self, name, attrs):
+                self.events.append((name, attrs))
+            def visit_content(self, content):
+                self.events.append(content)
+        self.assertEqual(Recorder().visit(self.buffer()).events,
+                         Recorder().visit(self.plant()).events)
+
+    def test_errors(self):
+        buf = PlantBuffer()
+        self.assertRaises(ValueError, buf.text, 'text')
+        self.assertRaises(ValueError, buf.end)
+        buf.start('root')
+        self.assertRaisesRegexp(ValueError, 'unclosed', encode, buf)
+        buf.end()
+        self.assertRaises(ValueError, buf.start, 'second')
+        self.assertEqual(encode(buf), '<?xml version="1.0"?>\n<root/>')
+
+
+class LazyChildrenTests(unittest.TestCase):
+
+    def sample(self):
+        rows = lambda: (('row', {'id': str(i)}, 'text', ('cell', str(i)))
+                        for i in range(3))
+        return ('rows',
+                  rows(),
+                  'tail',
+                  ('empty', iter([])),
+                  ('nested', iter([iter([('a',)]), iter([]), 'b'])),
+                  rows())
+
+    def flat(self):
+        rows = tuple(('row', {'id': str(i)}, 'text', ('cell', str(i)))
+                     for i in range(3))
+        return ('rows',) + rows + ('tail',
+                                   ('empty',),
+                                   ('nested', ('a',), 'b')) + rows
+
+    def test_encode(self):
+        for indent in (0, 2):
+            self.assertEqual(encode(self.sample(), indent=indent),
+                             encode(self.flat(), indent=indent))
+
+    def test_encode_iter(self):
+        self.assertEqual(''.join(encode_iter(self.sample(), indent=2,
+                                             namespaces=[])),
+                         encode(self.flat(), indent=2))
+        self.assertRaises(ValueError, list, encode_iter(self.sample()))
+
+    def test_encode_parallel(self):
+        from multiprocessing.pool import ThreadPool
+        self.assertEqual(encode_parallel(self.sample(), indent=2,
+                                         namespaces=[], chunk_size=2,
+                                         pool=ThreadPool(2)),
+                         encode(self.flat(), indent=2))
+        # nested lazy children can not be visited to collect namespaces
+        self.assertRaises(ValueError, encode_parallel, self.sample(),
+                          pool=ThreadPool(2))
+        self.assertEqual(encode_parallel(('rows', iter([('row',)])),
+                                         pool=ThreadPool(2)),
+                         encode(('rows', ('row',))))
+
+    def test_deeply_nested(self):
+        # every level is spliced into the same iterator of children, it
+        # takes time linear in number of levels
+        def sample(n=20000):
+            def level(i):
+                yield ('row', str(i))
+                if i < n:
+                    yield level(i+1)
+                yield 'tail'
+            return ('rows', level(0))
+        flat = ('rows',) + tuple(('row', str(i)) for i in range(20001)) + \
+               ('tail',) * 20001
+        expected = encode(flat)
+        self.assertEqual(encode(sample()), expected)
+        self.assertEqual(''.join(encode_iter(sample(), namespaces=[])),
+                         expected)
+        self.assertEqual(encode(sample(), cache=EncodeCache()), expected)
+        self.assertEqual(encode(sample(), canonical=True),
+                         encode(flat, canonical=True))
+        self.assertEqual(ElementTree.tostring(to_etree(sample())),
+                         ElementTree.tostring(to_etree(flat)))
+        class Counter(Visitor):
+            tags = 0
+            def visit_tag(self, name, attrs):
+                self.tags += 1
+        self.assertEqual(Counter().visit(sample()).tags, 20002)
+
+    def test_children_are_consumed_lazily(self):
+        consumed = []
+        def rows():
+            for i in range(3):
+                consumed.append(i)
+                yield ('row', i)
+        chunks = encode_iter(('rows', rows()), namespaces=[], chunk_size=1)
+        self.assertEqual(next(chunks), '<?xml version="1.0"?>\n')
+        self.assertEqual(next(chunks), '<rows>')
+        self.assertEqual(consumed, [0])
+
+    def test_to_etree(self):
+        self.assertEqual(ElementTree.tostring(to_etree(self.sample())),
+                         ElementTree.tostring(to_etree(self.flat())))
+
+    def test_visitor(self):
+        class Recorder(Visitor):
+            def __init__(self):
+                self.events = []
+            def visit_tag(self, name, attrs):
+                self.events.append(name)
+            def visit_content(self, content):
+                self.events.append(content)
+        self.assertEqual(Recorder().visit(self.sample()).events,
+                         Recorder().visit(self.flat()).events)
+
+
+class FromEtreeTests(unittest.TestCase):
+
+    ns = namespace('http://x/', 'x')
+
+    def sample(self):
+        ns = self.ns
+        return (ns.root, {'attr': 'value', ns.attr: 'nsvalue'},
+                  'text',
+                  ('child', u'текст', ('deep', ('deeper', 'd')), 'tail'),
+                  (ns.item, {'id': '1'}, 'one'),
+                  'between',
+                  (ns.item, {'id': '2'}, 'two'),
+                  ('empty',),
+                  'end')
+
+    def test_round_trip(self):
+        plant = from_etree(to_etree(self.sample()), namespaces=[self.ns])
+        self.assertEqual(encode(plant), encode(self.sample()))
+        self.assertEqual(plant[0], self.ns.root)
+        self.assertEqual(plant[0].uri, self.ns.uri)
+
+    @unittest.skipUnless(has_lxml, 'lxml is not installed')
+    def test_round_trip_lxml(self):
+        plant = from_etree(to_etree(self.sample(), impl=etree),
+                           namespaces=[self.ns])
+        self.assertEqual(encode(plant), encode(self.sample()))
+
+    def test_unknown_namespace_prefix(self):
+        plant = from_etree(to_etree(self.sample()))
+        self.assertEqual(plant[0].prefix, 'ns0')
+        self.assertEqual(plant[0].to_etree(), '{http://x/}root')
+
+    def test_comments_are_skipped(self):
+        tree = ElementTree.Element('a')
+        tree.text = '1'
+        ElementTree.SubElement(tree, ElementTree.Comment).tail = '2'
+        ElementTree.SubElement(tree, 'b').tail = '3'
+        self.assertEqual(from_etree(tree), ('a', '1', '2', ('b',), '3'))
+
+    def test_deeper_than_recursion_limit(self):
+        tag = ('tag',)
+        for i in range(sys.getrecursionlimit() * 2):
+            tag = ('tag', tag)
+        self.assertEqual(_encode_tag(from_etree(to_etree(tag)), indent=0),
+                         _encode_tag(tag, indent=0))
+
+    def test_iter_plants(self):
+        source = StringIO(encode(self.sample(), indent=2))
+        plants = list(iter_plants(source, tag=self.ns.item))
+        self.assertEqual(plants, [(self.ns.item, {'id': '1'}, 'one'),
+                                  (self.ns.item, {'id': '2'}, 'two')])
+        # prefix is taken from the document
+        self.assertEqual(plants[0][0].prefix, 'x')
+
+    def test_iter_plants_root_children(self):
+        source = StringIO(encode(self.sample()))
+        plants = list(iter_plants(source))
+        self.assertEqual([p[0] for p in plants],
+                         ['child', self.ns.item, self.ns.item, 'empty'])
+        self.assertEqual(encode(plants[0]),
+                         encode(('child', u'текст', ('deep', ('deeper', 'd')),
+                                 'tail')))
+
+    def test_iter_plants_clears_elements(self):
+        elements = []
+        class Recording(object):
+            @staticmethod
+            def iterparse(source, events):
+                for event, element in ElementTree.iterparse(source, events):
+                    if event == 'start':
+                        elements.append(element)
+                    yield event, element
+        source = StringIO(encode(self.sample()))
+        list(iter_plants(source, tag=self.ns.item, impl=Recording))
+        root = elements[0]
+        self.assertEqual(len(root), 0)
+
+
 if __name__=='__main__':
     unittest.main()
 